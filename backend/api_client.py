@@ -0,0 +1,451 @@
+import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import random
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # only the async views (ASYNC_VIEWS) need it
+    httpx = None
+
+from metrics import record_upstream, record_retry
+from config import (
+    HTTP_TIMEOUT, HTTP_MAX_RETRIES, HTTP_POOL_SIZE, RATE_LIMITS, DEFAULT_RATE_LIMIT,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS, TOKEN_REFRESH_MARGIN,
+    SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_API_URL, SPOTIFY_ACCOUNTS_URL, RECCO_API_URL,
+)
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+
+def backoff_delay(attempt, base=0.25, cap=8.0):
+    """Full-jitter exponential backoff: uniform(0, min(cap, base * 2**attempt))"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RateLimiter:
+    """
+    Spaces out requests to one upstream so all threads together never go faster than
+    `rate` requests per second. pause() pushes the next slot into the future for
+    everyone, e.g. after a 429.
+    """
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Claims the next slot; returns how long to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        return slot - now
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """
+    Classic closed / open / half-open breaker. After `failure_threshold` consecutive
+    failures the upstream is skipped for `reset_timeout` seconds, then one trial
+    call is let through; its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            trial_running = self._trial_started_at is not None and now - self._trial_started_at < self.reset_timeout
+            if now - self._opened_at < self.reset_timeout or trial_running:
+                raise CircuitOpenError(f"{self.name} circuit is open")
+            self._trial_started_at = now
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_started_at = None
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class SpotifyToken:
+    """
+    Client-credentials access token, fetched on first use and refreshed
+    TOKEN_REFRESH_MARGIN seconds before it expires.
+    """
+
+    def __init__(self, client_id, client_secret, token_url, session=None):
+        self._configured = bool(client_id and client_secret)
+        credentials = f"{client_id}:{client_secret}"
+        self._auth_header = f"Basic {base64.b64encode(credentials.encode()).decode()}"
+        self._token_url = token_url
+        self._session = session or requests.Session()
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._configured:
+            raise RuntimeError("SPOTIFY_CLIENT_ID / SPOTIFY_CLIENT_SECRET are not set")
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires_at - TOKEN_REFRESH_MARGIN:
+                self._refresh()
+            return self._token
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+
+    def _refresh(self):
+        started = time.perf_counter()
+        resp = self._session.post(
+            self._token_url,
+            headers={
+                "Authorization": self._auth_header,
+                "Content-Type": "application/x-www-form-urlencoded",
+            },
+            data={"grant_type": "client_credentials"},
+            timeout=HTTP_TIMEOUT,
+        )
+        record_upstream("spotify_token", resp.status_code, time.perf_counter() - started, len(resp.content))
+        resp.raise_for_status()
+        payload = resp.json()
+        self._token = payload["access_token"]
+        self._expires_at = time.monotonic() + payload.get("expires_in", 3600)
+
+
+class ApiClient:
+    """
+    Pooled keep-alive HTTP client for one upstream: uniform timeouts, per-upstream
+    rate limiting, jittered retries on connection errors / 429 / 5xx and a circuit breaker.
+    Paths are joined onto base_url; absolute URLs (e.g. pagination links) are used as-is.
+    """
+
+    def __init__(self, name, base_url, rate=DEFAULT_RATE_LIMIT, token=None,
+                 timeout=HTTP_TIMEOUT, max_retries=HTTP_MAX_RETRIES, pool_size=HTTP_POOL_SIZE):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.limiter = RateLimiter(rate)
+        self.breaker = CircuitBreaker(name)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def request(self, method, path, headers=None, timeout=None, **kwargs):
+        """
+        Returns the final response (callers still raise_for_status()). Raises
+        CircuitOpenError while the breaker is open, or the last connection error.
+        """
+        attempts = _Attempts(self)
+        url = self.url(path)
+        headers = dict(headers or {})
+        while True:
+            if self.token is not None:
+                with attempts.fetching_token():
+                    headers["Authorization"] = f"Bearer {self.token.get()}"
+            self.limiter.acquire()
+            started = time.perf_counter()
+            try:
+                resp = self.session.request(method, url, headers=headers, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                delay = attempts.transport_error(e, started)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            delay = attempts.response(resp, started)
+            if delay is None:
+                return resp
+            time.sleep(delay)
+
+
+class _Attempts:
+    """
+    The retry state machine of one ApiClient / AsyncApiClient request, so both follow the same
+    rules; the clients only do the I/O and the waiting. Checks the breaker when created.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.attempt = 0
+        self.refreshed = False
+        client.breaker.before_call()
+
+    @contextlib.contextmanager
+    def fetching_token(self):
+        """Wraps the token fetch: a failed one counts against the breaker"""
+        try:
+            yield
+        except requests.RequestException:
+            self.client.breaker.record_failure()
+            raise
+
+    def transport_error(self, error, started):
+        """
+        Records a connection error. Returns how long to wait before trying again,
+        or None when out of retries (the caller re-raises).
+        """
+        client = self.client
+        record_upstream(client.name, type(error).__name__, time.perf_counter() - started)
+        if self.attempt >= client.max_retries:
+            client.breaker.record_failure()
+            return None
+        record_retry(client.name, "connection")
+        return self._next_attempt(backoff_delay(self.attempt))
+
+    def response(self, resp, started):
+        """
+        Records a response. Returns how long to wait before trying again, or None when
+        resp is the one to hand back (success, a client error, or out of retries).
+        """
+        client = self.client
+        record_upstream(client.name, resp.status_code, time.perf_counter() - started, len(resp.content))
+
+        if resp.status_code == 401 and client.token is not None and not self.refreshed:
+            # token revoked or expired early: fetch a new one once
+            record_retry(client.name, "token")
+            client.token.invalidate()
+            self.refreshed = True
+            return 0.0
+
+        if resp.status_code == 429 or resp.status_code >= 500:
+            if self.attempt >= client.max_retries:
+                if resp.status_code >= 500:
+                    client.breaker.record_failure()
+                else:
+                    client.breaker.record_success()  # throttled, not broken
+                return None
+            record_retry(client.name, "throttled" if resp.status_code == 429 else "server_error")
+            delay = _retry_after(resp)
+            if delay is None:
+                delay = backoff_delay(self.attempt)
+            if resp.status_code == 429:
+                # every caller waits it out at the limiter, not just this one
+                client.limiter.pause(delay)
+                delay = 0.0
+            return self._next_attempt(delay)
+
+        client.breaker.record_success()
+        return None
+
+    def _next_attempt(self, delay):
+        self.attempt += 1
+        return delay
+
+
+class EventLoopPool:
+    """
+    Long-lived event loops on worker threads, for async views (create_app hands async_to_sync to
+    Flask). Flask's default runs every async view on a brand new loop, and an httpx pool only
+    works on the loop it was opened on, so the async clients' keep-alive connections would be
+    thrown away after each request; on these loops the next request reuses them.
+    This is about connection reuse, not concurrency: each loop runs one view at a time and the
+    WSGI thread serving the view waits for it, so async views are capped at `size` at once per
+    process. One view per loop is deliberate - the views' DB calls are blocking and hold pooled
+    connections across awaits, so views sharing a loop can stall each other on the DB pool.
+    """
+
+    def __init__(self, size):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix="spinder-loop")
+        self._local = threading.local()
+
+    def _run(self, context, func, args, kwargs):
+        loop = getattr(self._local, "loop", None)
+        if loop is None:
+            loop = self._local.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        # the task copies the context it is created in (Task(context=...) needs Python 3.11)
+        return loop.run_until_complete(context.run(loop.create_task, func(*args, **kwargs)))
+
+    def async_to_sync(self, func):
+        """Sync wrapper running func on one of the loops, in the caller's context (Flask's request context)"""
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            return self._pool.submit(self._run, contextvars.copy_context(), func, args, kwargs).result()
+
+        return run
+
+
+class AsyncApiClient:
+    """
+    asyncio twin of an ApiClient, on httpx. Shares the sync client's base URL, token,
+    rate limiter, circuit breaker and retry rules (_Attempts), so both paths together stay
+    within the upstream's limits and see the same health. One instance per upstream (aspotify,
+    arecco), with an httpx pool per event loop it is used on: with EventLoopPool's long-lived
+    loops, connections are kept alive across requests. Transport errors surface as
+    httpx.TransportError, error statuses via raise_for_status() as httpx.HTTPStatusError.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._http = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+        self._lock = threading.Lock()
+
+    def _http_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            http = self._http.get(loop)
+            if http is None:
+                connect, read = self.client.timeout
+                http = self._http[loop] = httpx.AsyncClient(
+                    timeout=httpx.Timeout(read, connect=connect),
+                    limits=httpx.Limits(max_connections=self.client.pool_size,
+                                        max_keepalive_connections=self.client.pool_size),
+                )
+            return http
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def request(self, method, path, headers=None, **kwargs):
+        """Same as ApiClient.request, awaiting instead of blocking."""
+        client = self.client
+        attempts = _Attempts(client)
+        url = client.url(path)
+        headers = dict(headers or {})
+        while True:
+            if client.token is not None:
+                with attempts.fetching_token():
+                    # only blocks when the token has to be refreshed
+                    headers["Authorization"] = f"Bearer {await asyncio.to_thread(client.token.get)}"
+            wait = client.limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            started = time.perf_counter()
+            try:
+                resp = await self._http_client().request(method, url, headers=headers, **kwargs)
+            except httpx.TransportError as e:
+                delay = attempts.transport_error(e, started)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            delay = attempts.response(resp, started)
+            if delay is None:
+                return resp
+            await asyncio.sleep(delay)
+
+
+# What callers of either client catch for "this upstream call didn't work"
+UPSTREAM_ERRORS = (requests.RequestException, httpx.HTTPError) if httpx is not None else (requests.RequestException,)
+
+
+def _retry_after(resp):
+    header = resp.headers.get("Retry-After")
+    if not header:
+        return None
+    try:
+        return max(float(header), 0.0)
+    except ValueError:
+        return None
+
+
+def _result_size(result):
+    # SDK calls return text (Gemini); count it like a response body
+    return len(result.encode()) if isinstance(result, str) else 0
+
+
+def _client_error(e):
+    """SDK errors carrying a 4xx `code` other than 429 are the caller's fault: no retry, no breaker trip"""
+    code = getattr(e, "code", None)
+    return isinstance(code, int) and 400 <= code < 500 and code != 429
+
+
+def call_with_retries(fn, breaker, max_retries=HTTP_MAX_RETRIES):
+    """
+    Retry/breaker wrapper for SDK calls that don't go through ApiClient (Gemini).
+    Errors carrying a 4xx `code` other than 429 are not retried and don't trip the breaker.
+    """
+    breaker.before_call()
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            record_upstream(breaker.name, type(e).__name__, time.perf_counter() - started)
+            if _client_error(e):
+                breaker.record_success()
+                raise
+            if attempt >= max_retries:
+                breaker.record_failure()
+                raise
+            record_retry(breaker.name, "error")
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        record_upstream(breaker.name, "ok", time.perf_counter() - started, _result_size(result))
+        breaker.record_success()
+        return result
+
+
+spotify_token = SpotifyToken(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_ACCOUNTS_URL)
+spotify = ApiClient("spotify", SPOTIFY_API_URL, rate=RATE_LIMITS["spotify"], token=spotify_token)
+recco = ApiClient("recco", RECCO_API_URL, rate=RATE_LIMITS["recco"])
+aspotify = AsyncApiClient(spotify)
+arecco = AsyncApiClient(recco)
+gemini_breaker = CircuitBreaker("gemini")
@@ -0,0 +1,276 @@
+"""
+Offline benchmarks: runs the backend in-process against fake_upstream.py (no network access needed)
+and reports latency, per-stage breakdown, upstream calls and peak Python memory for
+getReccoSongProperties, GET /link/<playlist> and POST /songids at several playlist sizes,
+plus throughput with concurrent sessions.
+
+    python benchmark.py --sizes 10,100,1000,10000 --sessions 8 --json bench.json
+
+Each size runs on cold caches and a fresh database. Rate limits are lifted unless
+--keep-rate-limits is given, so the numbers measure the backend rather than the limiter.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from fake_upstream import FakeUpstreams, track_id
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class TimingCapture(logging.Handler):
+    """Collects the per-request 'request timing' log lines (see app._log_request_timing)"""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        if record.msg.startswith("request timing"):
+            with self._lock:
+                self.records.append(json.loads(record.args[0]))
+
+    def take(self):
+        with self._lock:
+            records, self.records = self.records, []
+        return records
+
+
+class Bench:
+    def __init__(self, args, fake):
+        self.args = args
+        self.fake = fake
+        # config.py reads the environment on import, so the app is only imported now
+        import app as app_module
+        import gemini
+        from flask.logging import default_handler
+        from cache import track_cache
+        from db import reset_schema
+
+        self.app_module = app_module
+        self.flask_app = app_module.create_app()
+        self.reset_schema = reset_schema
+        self.caches = (track_cache, gemini.response_cache)
+        self.capture = TimingCapture()
+        # timing lines go to the report instead of stderr
+        self.flask_app.logger.removeHandler(default_handler)
+        self.flask_app.logger.propagate = False
+        self.flask_app.logger.addHandler(self.capture)
+        self.flask_app.logger.setLevel(logging.INFO)
+        self.results = []
+
+    def reset(self):
+        """Cold start: empty caches and a fresh schema"""
+        for cache in self.caches:
+            cache.clear()
+        with self.flask_app.app_context():
+            self.reset_schema()
+        self.capture.take()
+
+    def _upstream_calls(self, before):
+        after = dict(self.fake.requests)
+        calls = {}
+        for (upstream, status), count in after.items():
+            delta = count - before.get((upstream, status), 0)
+            if delta:
+                calls[f"{upstream}:{status}"] = delta
+        return calls
+
+    def measure(self, name, size, fn):
+        """Runs fn() cold for latency, then again cold under tracemalloc for peak memory"""
+        self.reset()
+        before = dict(self.fake.requests)
+        started = time.perf_counter()
+        ok = fn()
+        elapsed = time.perf_counter() - started
+        timings = self.capture.take()
+        result = {
+            "bench": name,
+            "size": size,
+            "ok": ok,
+            "ms": round(elapsed * 1000, 1),
+            "upstream_calls": self._upstream_calls(before),
+        }
+        if timings:
+            result["stages_ms"] = timings[-1].get("stages", {})
+            result["db_ms"] = timings[-1].get("db", {})
+
+        if not self.args.skip_memory:
+            self.reset()
+            tracemalloc.start()
+            try:
+                fn()
+                result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            finally:
+                tracemalloc.stop()
+            self.capture.take()
+
+        self.results.append(result)
+        self.print_result(result)
+        return result
+
+    @staticmethod
+    def print_result(result):
+        stages = " ".join(f"{k}={v:.0f}" for k, v in result.get("stages_ms", {}).items())
+        calls = sum(result["upstream_calls"].values())
+        print(f"{result['bench']:<16} {result['size']:>6} {result['ms']:>10.1f} ms "
+              f"{result.get('peak_mb', float('nan')):>8.2f} MB {calls:>7} calls  {'ok' if result['ok'] else 'FAIL'}  {stages}",
+              flush=True)
+
+    # --- benchmarks
+
+    def recco_features(self, size):
+        ids = [track_id("B", n) for n in range(size)]
+
+        def run():
+            with self.flask_app.app_context():
+                details = self.app_module.getReccoSongProperties(ids)
+            return sum(1 for d in details if d["song_features"]) == size
+
+        return self.measure("recco_features", size, run)
+
+    def link(self, size):
+        def run():
+            response = self.flask_app.test_client().get(f"/link/{size}-link", headers={"X-Session-ID": f"link-{size}"})
+            body = response.get_json()
+            response.close()
+            return response.status_code == 200 and len(body) > 0
+
+        return self.measure("/link", size, run)
+
+    def songids(self, size):
+        ids = [track_id("I", n) for n in range(size)]
+
+        def run():
+            response = self.flask_app.test_client().post("/songids", json=ids, headers={"X-Session-ID": f"ids-{size}"})
+            body = response.get_json()
+            response.close()
+            return response.status_code == 200 and len(body) > 0
+
+        return self.measure("/songids", size, run)
+
+    def throughput(self, sessions, requests_per_session, size):
+        """`sessions` threads, each linking its own playlist `requests_per_session` times"""
+        self.reset()
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def session(n):
+            client = self.flask_app.test_client()
+            for i in range(requests_per_session):
+                started = time.perf_counter()
+                try:
+                    response = client.get(f"/link/{size}-s{n}", headers={"X-Session-ID": f"load-{n}"})
+                    ok = response.status_code == 200 and len(response.get_json()) > 0
+                    error = None if ok else f"session {n} request {i}: HTTP {response.status_code}"
+                    response.close()
+                except Exception as e:
+                    error = f"session {n} request {i}: {e!r}"
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+                    if error:
+                        errors.append(error)
+
+        before = dict(self.fake.requests)
+        started = time.perf_counter()
+        threads = [threading.Thread(target=session, args=(n,)) for n in range(sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+        self.capture.take()
+
+        result = {
+            "bench": "throughput",
+            "size": size,
+            "sessions": sessions,
+            "requests": len(latencies),
+            "errors": len(errors),
+            "error_samples": errors[:5],
+            "ok": not errors,
+            "ms": round(wall * 1000, 1),
+            "requests_per_s": round(len(latencies) / wall, 2) if wall else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 1),
+            "upstream_calls": self._upstream_calls(before),
+        }
+        self.results.append(result)
+        print(f"throughput       {size:>6} {sessions} sessions x {requests_per_session}: "
+              f"{result['requests_per_s']} req/s  p50={result['p50_ms']} ms  p95={result['p95_ms']} ms  "
+              f"errors={result['errors']}", flush=True)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="playlist sizes, comma separated")
+    parser.add_argument("--benches", default="recco_features,link,songids,throughput")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent sessions for the throughput run")
+    parser.add_argument("--requests", type=int, default=3, help="requests per session for the throughput run")
+    parser.add_argument("--throughput-size", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20, help="fake Spotify / Recco latency")
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--gemini-latency-ms", type=float, default=500)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream responses that are 500s")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of upstream responses that are 429s")
+    parser.add_argument("--mode", default=None, help="RECOMMEND_MODE (gemini | rerank | local)")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--skip-memory", action="store_true", help="skip the tracemalloc pass (it is slow)")
+    parser.add_argument("--json", help="write the results here")
+    args = parser.parse_args()
+
+    fake = FakeUpstreams(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                         gemini_latency=args.gemini_latency_ms / 1000,
+                         error_rate=args.error_rate, throttle_rate=args.throttle_rate).start()
+    workdir = tempfile.mkdtemp(prefix="spinder-bench-")
+    os.environ.update(fake.env())
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "DB_MIGRATE": "reset",
+        "PREFETCH_NEXT_BATCH": "0",  # background batches would land in the next measurement
+        "DEBUG_PROMPTS": "0",
+    })
+    if args.mode:
+        os.environ["RECOMMEND_MODE"] = args.mode
+    if not args.keep_rate_limits:
+        os.environ["RECCO_RATE_LIMIT"] = os.environ["SPOTIFY_RATE_LIMIT"] = "1000000"
+
+    bench = Bench(args, fake)
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    benches = args.benches.split(",")
+    print(f"{'bench':<16} {'size':>6} {'latency':>13} {'peak':>11} {'upstream':>13}", flush=True)
+    for size in sizes:
+        if "recco_features" in benches:
+            bench.recco_features(size)
+        if "link" in benches:
+            bench.link(size)
+        if "songids" in benches:
+            bench.songids(size)
+    if "throughput" in benches:
+        bench.throughput(args.sessions, args.requests, args.throughput_size)
+    fake.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": bench.results}, f, indent=2)
+    return 0 if all(r["ok"] for r in bench.results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import has_app_context
+
+from config import CACHE_LRU_SIZE, CACHE_TTLS, NEGATIVE_CACHE_TTL
+from metrics import record_cache
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU with a per-entry expiry time.
+    get() returns (True, value) on a hit and (False, None) on a miss so that
+    None can be cached as a real value.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TrackCache:
+    """
+    Two-level cache for per-track upstream payloads, keyed by (source, normalized spotify id).
+    The LRU sits in front of the track_cache table; the table is only touched when
+    there is an app context, so scripts like ReccoTester.py still get the LRU.
+    Payloads of None mean "upstream had nothing" and expire after NEGATIVE_CACHE_TTL.
+    """
+
+    def __init__(self, ttls, maxsize):
+        self.ttls = ttls
+        self._lru = LRUCache(maxsize)
+        self._stats_lock = threading.Lock()
+        self._stats = {source: {"memory_hits": 0, "db_hits": 0, "misses": 0} for source in ttls}
+
+    def _ttl(self, source, payload):
+        return NEGATIVE_CACHE_TTL if payload is None else self.ttls[source]
+
+    def _count(self, source, field, n):
+        if n:
+            with self._stats_lock:
+                self._stats[source][field] += n
+            record_cache("track", source, field, n)
+
+    def get_many(self, source, spotify_ids):
+        """Returns ({spotify_id: payload} for fresh hits, [spotify_ids still to fetch])"""
+        found = {}
+        pending = []
+        for spotify_id in dict.fromkeys(spotify_ids):
+            hit, payload = self._lru.get((source, spotify_id))
+            if hit:
+                found[spotify_id] = payload
+            else:
+                pending.append(spotify_id)
+        self._count(source, "memory_hits", len(found))
+
+        missing = pending
+        if pending and has_app_context():
+            from db import get_cached_entries
+
+            now = time.time()
+            missing = []
+            rows = get_cached_entries(source, pending)
+            db_hits = 0
+            for spotify_id in pending:
+                row = rows.get(spotify_id)
+                if row is None:
+                    missing.append(spotify_id)
+                    continue
+                payload, fetched_at = row
+                expires_at = fetched_at + self._ttl(source, payload)
+                if expires_at <= now:
+                    missing.append(spotify_id)
+                    continue
+                found[spotify_id] = payload
+                self._lru.set((source, spotify_id), payload, expires_at)
+                db_hits += 1
+            self._count(source, "db_hits", db_hits)
+
+        self._count(source, "misses", len(missing))
+        return found, missing
+
+    def put_many(self, source, entries):
+        """Stores {spotify_id: payload} in the LRU and, when possible, the track_cache table"""
+        if not entries:
+            return
+        now = time.time()
+        for spotify_id, payload in entries.items():
+            self._lru.set((source, spotify_id), payload, now + self._ttl(source, payload))
+        if has_app_context():
+            from db import put_cached_entries
+            put_cached_entries(source, entries, now)
+
+    def clear(self):
+        """Empties the in-process LRU (the track_cache table is left alone)"""
+        self._lru.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {source: dict(counts) for source, counts in self._stats.items()}
+        stats["lru_size"] = len(self._lru)
+        return stats
+
+
+track_cache = TrackCache(CACHE_TTLS, CACHE_LRU_SIZE)
@@ -7,8 +7,109 @@ db = SQLAlchemy()
     db.Column('song_id', db.Integer, db.ForeignKey('songs.id'), primary_key=True),
     db.Column('artist_id', db.Integer, db.ForeignKey('artists.id'), primary_key=True)
 )"""
+import functools
+import random
+import time
+import uuid
+
 from flask import current_app
-from sqlalchemy import text
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+from metrics import DB_RETRIES, timed_db
+
+# Used by clients that don't send a session id (keeps the old single-user behaviour)
+DEFAULT_SESSION_ID = "default"
+
+
+def _in_memory(url):
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def release_connections():
+    """
+    Closes the pooled connections, e.g. before gunicorn forks workers from a preloaded app.
+    In-memory SQLite is left alone: closing its connection would drop the database.
+    """
+    if not _in_memory(db.engine.url):
+        db.engine.dispose()
+
+
+def engine_options(config):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS for the configured database: a pool sized from DB_POOL_* with
+    pre-ping (PostgreSQL drops idle connections). In-memory SQLite keeps SQLAlchemy's single-connection pool.
+    """
+    options = {"pool_pre_ping": True}
+    if _in_memory(make_url(config["SQLALCHEMY_DATABASE_URI"])):
+        return options
+    options.update(
+        pool_size=config["DB_POOL_SIZE"],
+        max_overflow=config["DB_MAX_OVERFLOW"],
+        pool_timeout=config["DB_POOL_TIMEOUT"],
+        pool_recycle=config["DB_POOL_RECYCLE"],
+    )
+    return options
+
+
+def configure_engine(app):
+    """
+    Per-connection setup for the app's engine: on SQLite, the journal / sync / busy-timeout / mmap
+    pragmas from config, so concurrent workers wait for the write lock instead of failing at once.
+    Call after db.init_app and before the first connection.
+    """
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != "sqlite":
+        return
+    config = app.config
+    pragmas = (
+        f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+    )
+
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+def _lock_conflict(error):
+    """SQLite lock timeouts, PostgreSQL serialization failures and deadlocks: worth another try"""
+    orig = getattr(error, "orig", None)
+    if getattr(orig, "pgcode", None) in ("40001", "40P01"):
+        return True
+    message = str(orig or error).lower()
+    return "database is locked" in message or "database table is locked" in message
+
+
+def retry_on_lock(fn):
+    """
+    Re-runs a write helper, after a rollback, when another worker holds the lock
+    (up to DB_RETRY_ATTEMPTS times, full-jitter backoff). Wrapped helpers must be safe to re-run.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        attempts = max(1, current_app.config["DB_RETRY_ATTEMPTS"])
+        base_delay = current_app.config["DB_RETRY_BASE_DELAY"]
+        for attempt in range(attempts):
+            try:
+                return fn(*args, **kwargs)
+            except OperationalError as e:
+                db.session.rollback()
+                if attempt == attempts - 1 or not _lock_conflict(e):
+                    raise
+                DB_RETRIES.inc(op=fn.__name__)
+                time.sleep(random.uniform(0, base_delay * 2 ** attempt))
+
+    return wrapper
 
 
 def reset_schema():
@@ -21,133 +122,681 @@ def reset_schema():
         db.create_all()
 
 
+def stale_tables():
+    """Existing tables missing columns the models now have (create_all can't fix those)"""
+    inspector = db.inspect(db.engine)
+    stale = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        if set(table.columns.keys()) - existing:
+            stale.append(table.name)
+    return stale
+
+
+def migrate_schema(mode="create"):
+    """
+    Brings the schema in line with the models.
+      "none"   - leave the database alone
+      "create" - create missing tables only; never drops anything
+      "reset"  - drop_all + create_all (dev only, wipes ALL data)
+    Returns the tables that are still out of date (see stale_tables).
+    """
+    if mode == "none":
+        return []
+    if mode == "reset":
+        reset_schema()
+        return []
+    db.create_all()
+    return stale_tables()
+
+
+class UserSession(db.Model):
+    """One swipe session: owns its seed songs and the recommendations already served"""
+    __tablename__ = "sessions"
+    id = db.Column(db.String(36), primary_key=True)
+    created_at = db.Column(db.Float, nullable=False)
+    last_seen_at = db.Column(db.Float, nullable=False, index=True)  # for bulk expiry
+
+
 class Song(db.Model):
     __tablename__ = "songs"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.String(36), db.ForeignKey("sessions.id"), nullable=False, index=True)
     spotify_id = db.Column(db.String(100), nullable=False)
     name = db.Column(db.String(200), nullable=False)
     artists = db.Column(db.JSON, nullable=False)  # list of strings
-    # Audio features for Gemini analysis
-    tempo = db.Column(db.Float, nullable=True)
-    danceability = db.Column(db.Float, nullable=True)
-    energy = db.Column(db.Float, nullable=True)
-    valence = db.Column(db.Float, nullable=True)
-    acousticness = db.Column(db.Float, nullable=True)
-    instrumentalness = db.Column(db.Float, nullable=True)
-    liveness = db.Column(db.Float, nullable=True)
-    loudness = db.Column(db.Float, nullable=True)
-    speechiness = db.Column(db.Float, nullable=True)
-    key = db.Column(db.Integer, nullable=True)
-    mode = db.Column(db.Integer, nullable=True)
-    time_signature = db.Column(db.Integer, nullable=True)
+    # Audio features as one packed float32 array (similarity.STORED_FEATURES order, NaN = missing),
+    # so any number of rows loads into a NumPy matrix with a single frombuffer (see unpack_features)
+    features = db.Column(db.LargeBinary, nullable=True)
+
+    __table_args__ = (
+        # one row per track per session; bulk_upsert_songs relies on this for ON CONFLICT
+        db.UniqueConstraint("session_id", "spotify_id", name="uq_songs_session_spotify"),
+    )
+
+
+def recommendation_key(name, artists):
+    """Loose identity of a track across Spotify IDs: casefolded title + first artist, whitespace collapsed"""
+    first = artists[0] if isinstance(artists, list) and artists else artists or ""
+    return f"{' '.join(str(name).split()).casefold()}|{' '.join(str(first).split()).casefold()}"
+
 
 class Recommendation(db.Model):
     __tablename__ = "recommendations"
-    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # also the history cursor
+    session_id = db.Column(db.String(36), db.ForeignKey("sessions.id"), nullable=False, index=True)
     name = db.Column(db.String(200), nullable=False)
     artist = db.Column(db.JSON, nullable=False)
+    norm_key = db.Column(db.String(400), nullable=False)  # recommendation_key(name, artist)
+    spotify_id = db.Column(db.String(22), nullable=True)
+    image_url = db.Column(db.String(500), nullable=True)
+
+    __table_args__ = (
+        # a track is recommended at most once per session, however Gemini spells it
+        db.UniqueConstraint("session_id", "norm_key", name="uq_recommendations_session_key"),
+        db.UniqueConstraint("session_id", "spotify_id", name="uq_recommendations_session_spotify"),
+    )
+
+class TrackCacheEntry(db.Model):
+    """Upstream payloads (Recco features, Spotify metadata/art) keyed by normalized Spotify ID"""
+    __tablename__ = "track_cache"
+    source = db.Column(db.String(20), primary_key=True)  # "features" | "track" | "art"
+    spotify_id = db.Column(db.String(22), primary_key=True)
+    payload = db.Column(db.JSON, nullable=True)  # None = upstream had nothing for this track
+    fetched_at = db.Column(db.Float, nullable=False)  # unix timestamp
+
+class Candidate(db.Model):
+    """Resolved recommendation Gemini over-generated, kept for the session's next batches"""
+    __tablename__ = "candidates"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # buffer order
+    session_id = db.Column(db.String(36), db.ForeignKey("sessions.id"), nullable=False, index=True)
+    name = db.Column(db.String(200), nullable=False)
+    artist = db.Column(db.JSON, nullable=False)
+    norm_key = db.Column(db.String(400), nullable=False)
+    spotify_id = db.Column(db.String(22), nullable=False)
+    image_url = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint("session_id", "norm_key", name="uq_candidates_session_key"),
+        db.UniqueConstraint("session_id", "spotify_id", name="uq_candidates_session_spotify"),
+    )
+
+
+class Feedback(db.Model):
+    """One swipe: the session liked (or passed on) a recommended track"""
+    __tablename__ = "feedback"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.String(36), db.ForeignKey("sessions.id"), nullable=False, index=True)
+    spotify_id = db.Column(db.String(22), nullable=False)
+    liked = db.Column(db.Boolean, nullable=False)
+    weight = db.Column(db.Float, nullable=False, default=1.0)
+    created_at = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        # the first swipe on a track counts; resent batches are no-ops
+        db.UniqueConstraint("session_id", "spotify_id", name="uq_feedback_session_track"),
+    )
+
+
+class SessionTaste(db.Model):
+    """Running taste profile of a session, updated per swipe (similarity.TasteProfile.to_dict())"""
+    __tablename__ = "taste_profiles"
+    session_id = db.Column(db.String(36), db.ForeignKey("sessions.id"), primary_key=True)
+    stats = db.Column(db.JSON, nullable=True)
+    updated_at = db.Column(db.Float, nullable=False)
+
+
+class Job(db.Model):
+    """A recommendation batch generated in the background (see jobs.py)"""
+    __tablename__ = "jobs"
+    id = db.Column(db.String(36), primary_key=True)
+    session_id = db.Column(db.String(36), db.ForeignKey("sessions.id"), nullable=False, index=True)
+    status = db.Column(db.String(10), nullable=False)  # queued | running | done | failed | served
+    result = db.Column(db.JSON, nullable=True)  # the resolved recommendations once done
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.Float, nullable=False)
+    finished_at = db.Column(db.Float, nullable=True)
 
 
 # Utility functions
 
-def create_song(spotify_id, name, artists, audio_features):
-    # Create the song
-    if audio_features is not None:
-        song = Song(
-            artists=artists,
-            spotify_id=spotify_id,
-            name=name,
-            # Audio features
-
-            tempo=audio_features.get('tempo'),
-            danceability=audio_features.get('danceability'),
-            energy=audio_features.get('energy'),
-            valence=audio_features.get('valence'),
-            acousticness=audio_features.get('acousticness'),
-            instrumentalness=audio_features.get('instrumentalness'),
-            liveness=audio_features.get('liveness'),
-            loudness=audio_features.get('loudness'),
-            speechiness=audio_features.get('speechiness'),
-            key=audio_features.get('key'),
-            mode=audio_features.get('mode'),
-            time_signature=audio_features.get('time_signature')
+@timed_db
+@retry_on_lock
+def get_or_create_session(session_id=None):
+    """
+    Returns the session with this id (creating it if needed) and marks it as seen.
+    With no id a fresh session with a random id is created.
+    last_seen_at is only written once it is SESSION_TOUCH_SECONDS old, so most requests don't write here.
+    """
+    now = time.time()
+    if not session_id:
+        user_session = UserSession(id=uuid.uuid4().hex, created_at=now, last_seen_at=now)
+        db.session.add(user_session)
+        db.session.commit()
+        return user_session
+
+    user_session = db.session.get(UserSession, session_id)
+    if user_session is None:
+        # another worker may be creating the same session right now
+        db.session.execute(
+            _dialect_insert(UserSession).on_conflict_do_nothing(),
+            [{"id": session_id, "created_at": now, "last_seen_at": now}],
         )
-    else:
-        song = Song(artists=artists,
-                    spotify_id=spotify_id,
-                    name=name)
+        db.session.commit()
+        user_session = db.session.get(UserSession, session_id)
+    elif now - user_session.last_seen_at >= current_app.config["SESSION_TOUCH_SECONDS"]:
+        user_session.last_seen_at = now
+        db.session.commit()
+    return user_session
 
-    db.session.add(song)
+
+@timed_db
+@retry_on_lock
+def expire_sessions(max_idle_seconds):
+    """Bulk-deletes sessions idle for longer than max_idle_seconds, with everything they own"""
+    cutoff = time.time() - max_idle_seconds
+    stale = db.select(UserSession.id).where(UserSession.last_seen_at < cutoff)
+    Recommendation.query.filter(Recommendation.session_id.in_(stale)).delete(synchronize_session=False)
+    Song.query.filter(Song.session_id.in_(stale)).delete(synchronize_session=False)
+    Job.query.filter(Job.session_id.in_(stale)).delete(synchronize_session=False)
+    Feedback.query.filter(Feedback.session_id.in_(stale)).delete(synchronize_session=False)
+    Candidate.query.filter(Candidate.session_id.in_(stale)).delete(synchronize_session=False)
+    SessionTaste.query.filter(SessionTaste.session_id.in_(stale)).delete(synchronize_session=False)
+    deleted = UserSession.query.filter(UserSession.last_seen_at < cutoff).delete(synchronize_session=False)
     db.session.commit()
-    return song
+    return deleted
+
 
+def _dialect_insert(model):
+    """INSERT for the bound dialect, so on_conflict_do_update is available (SQLite and PostgreSQL)"""
+    if db.session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
 
-def create_gemini_json():
+
+@timed_db
+@retry_on_lock
+def bulk_upsert_songs(session_id, spotify_ids, names, artists, recco_details):
     """
-    Create JSON object to send to Gemini with the exact format you need
-    
+    Writes a whole seed batch in one transaction.
+    Takes the aligned lists from getSpotifyTrackInfo (names, artists) and
+    getReccoSongProperties (recco_details). Tracks already in the session are
+    updated in place rather than duplicated. Slots with no id or name are skipped.
+
     Returns:
-        list: List of dictionaries, each containing song data for Gemini
-    """
-    songs = Song.query.all()
-    gemini_data = []
-
-    for song in songs:
-        song_data = {
-            "song_name": song.name,
-            "author_name": song.artists,  # List of artist names
-            "spotify_song_id": song.spotify_id,
-            "audio_features": {
-                "tempo": song.tempo,
-                "danceability": song.danceability,
-                "energy": song.energy,
-                "valence": song.valence,
-                "acousticness": song.acousticness,
-                "instrumentalness": song.instrumentalness,
-                "liveness": song.liveness,
-                "loudness": song.loudness,
-                "speechiness": song.speechiness,
-                "key": song.key,
-                "mode": song.mode,
-                "time_signature": song.time_signature
-            }
+        int: number of rows written
+    """
+    from similarity import pack_features
+
+    rows = {}
+    for spotify_id, name, song_artists, details in zip(spotify_ids, names, artists, recco_details):
+        if not spotify_id or name is None:
+            continue
+        # duplicates in one statement would conflict with themselves
+        rows[spotify_id] = {
+            "session_id": session_id,
+            "spotify_id": spotify_id,
+            "name": name,
+            "artists": song_artists or [],
+            "features": pack_features((details or {}).get("song_features")),
         }
-        gemini_data.append(song_data)
 
-    return gemini_data
+    if not rows:
+        return 0
+
+    stmt = _dialect_insert(Song)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["session_id", "spotify_id"],
+        set_={column: stmt.excluded[column] for column in ("name", "artists", "features")},
+    )
+    db.session.execute(stmt, list(rows.values()))
+    db.session.commit()
+    return len(rows)
+
+
+@timed_db
+def get_seed_songs(session_id):
+    """
+    This session's seed songs, columnar: ([{"song_name", "author_name", "spotify_song_id"}],
+    (n, len(STORED_FEATURES)) float32 feature matrix aligned with the rows, NaN = missing).
+    """
+    from similarity import STORED_FEATURES, unpack_features
+
+    rows = db.session.query(Song.name, Song.artists, Song.spotify_id, Song.features) \
+        .filter(Song.session_id == session_id).order_by(Song.id).all()
+    seeds = [{"song_name": row[0], "author_name": row[1], "spotify_song_id": row[2]} for row in rows]
+    return seeds, unpack_features([row[3] for row in rows], STORED_FEATURES)
+
+
+@timed_db
+def get_seed_features(session_id):
+    """(spotify_ids, feature matrix) for this session's seed songs (see similarity.unpack_features)"""
+    from similarity import unpack_features
+
+    rows = db.session.query(Song.spotify_id, Song.features).filter(Song.session_id == session_id).all()
+    return [row[0] for row in rows], unpack_features([row[1] for row in rows])
+
+
+@timed_db
+def get_catalog_songs():
+    """
+    Every distinct track with audio features across all sessions, columnar:
+    (spotify_ids, feature matrix). Used to build the local similarity index;
+    names come from get_track_names for the few tracks actually picked.
+    """
+    from similarity import unpack_features
+
+    # one row per track: the oldest copy (min(bytea) doesn't exist on PostgreSQL)
+    first = db.select(db.func.min(Song.id)).where(Song.features.isnot(None)).group_by(Song.spotify_id)
+    rows = db.session.query(Song.spotify_id, Song.features).filter(Song.id.in_(first)).all()
+    return [row[0] for row in rows], unpack_features([row[1] for row in rows])
+
+
+@timed_db
+def get_track_names(spotify_ids):
+    """{spotify_id: {"name", "artists"}} for seed tracks of any session"""
+    names = {}
+    spotify_ids = list(dict.fromkeys(spotify_ids))
+    for i in range(0, len(spotify_ids), 500):
+        rows = db.session.query(Song.spotify_id, Song.name, Song.artists) \
+            .filter(Song.spotify_id.in_(spotify_ids[i:i + 500]))
+        for row in rows:
+            names.setdefault(row[0], {"name": row[1], "artists": row[2]})
+    return names
+
 
+@timed_db
+@retry_on_lock
+def store_gemini_recommendations(session_id, recommended_songs, leftovers=(), taken=()):
+    """
+    Records served recommendations (with their Spotify ID and art when resolved).
+    Tracks the session was already recommended - by normalized key or Spotify ID - are skipped.
+    In the same transaction, the buffered candidates the batch read (taken, row ids from
+    get_candidates) are deleted and the ones it didn't use (leftovers) buffered again.
+    """
+    _delete_candidates(session_id, taken)
+    _insert_candidates(session_id, leftovers)
+    _insert_recommendations(session_id, recommended_songs)
+    db.session.commit()
 
-def store_gemini_recommendations(recommended_songs):
+
+def _insert_recommendations(session_id, recommended_songs):
+    """store_gemini_recommendations without the commit"""
+    rows = {}
+    spotify_ids = set()
     for rec_data in recommended_songs:
-        recommendation = Recommendation(
-            name=rec_data['name'],
-            artist=rec_data.get('artist'),
+        key = recommendation_key(rec_data['name'], rec_data.get('artist'))
+        spotify_id = rec_data.get('spotify_id')
+        if key in rows or (spotify_id and spotify_id in spotify_ids):
+            continue
+        spotify_ids.add(spotify_id)
+        rows[key] = {
+            "session_id": session_id,
+            "name": rec_data['name'],
+            "artist": rec_data.get('artist') or [],
+            "norm_key": key,
+            "spotify_id": spotify_id,
+            "image_url": rec_data.get('image_url'),
+        }
+    if not rows:
+        return
+
+    # no conflict target: skips rows hitting either unique constraint
+    db.session.execute(_dialect_insert(Recommendation).on_conflict_do_nothing(), list(rows.values()))
+
+
+def _recommendation_dict(rec):
+    return {
+        "name": rec.name,
+        "artist": rec.artist,
+        "spotify_id": rec.spotify_id,
+        "image_url": rec.image_url,
+    }
+
+
+@timed_db
+def get_recommendations(session_id, limit=None):
+    """
+    Recommendations already served in this session, oldest first.
+    With a limit only the newest `limit` are read (the prompt drops the oldest first anyway).
+    """
+    query = Recommendation.query.filter_by(session_id=session_id).order_by(Recommendation.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return [_recommendation_dict(rec) for rec in reversed(query.all())]
+
+
+@timed_db
+def get_recommendation_page(session_id, limit=50, cursor=None):
+    """
+    One page of the session's history, newest first. cursor is the next_cursor of the
+    previous page (a keyset on the id, so deep pages cost the same as the first).
+
+    Returns:
+        dict: {"items": [...], "next_cursor": int | None}
+    """
+    query = Recommendation.query.filter_by(session_id=session_id)
+    if cursor is not None:
+        query = query.filter(Recommendation.id < cursor)
+    rows = query.order_by(Recommendation.id.desc()).limit(limit + 1).all()
+    items = [{"id": rec.id, **_recommendation_dict(rec)} for rec in rows[:limit]]
+    return {"items": items, "next_cursor": rows[limit - 1].id if len(rows) > limit else None}
+
+
+def _present(column, session_id, values):
+    found = set()
+    values = [v for v in dict.fromkeys(values) if v]
+    for i in range(0, len(values), 500):
+        rows = db.session.query(column).filter(
+            column.class_.session_id == session_id,
+            column.in_(values[i:i + 500]),
         )
+        found.update(row[0] for row in rows)
+    return found
+
+
+@timed_db
+def recommended_keys(session_id, norm_keys):
+    """Which of these recommendation_key()s the session was already recommended (unique-index lookups)"""
+    return _present(Recommendation.norm_key, session_id, norm_keys)
+
+
+@timed_db
+def recommended_spotify_ids(session_id, spotify_ids):
+    """Which of these Spotify IDs the session was already recommended (unique-index lookups)"""
+    return _present(Recommendation.spotify_id, session_id, spotify_ids)
+
+
+@timed_db
+def seeded_spotify_ids(session_id, spotify_ids):
+    """Which of these Spotify IDs are seeds of the session (unique-index lookups)"""
+    return _present(Song.spotify_id, session_id, spotify_ids)
+
+
+def _insert_candidates(session_id, candidates):
+    """
+    Appends resolved recommendations ({"name", "artist", "spotify_id", "image_url"}) a batch didn't
+    need to the session's candidate buffer, in order. Tracks already buffered are skipped. No commit.
+    """
+    now = time.time()
+    rows = [
+        {
+            "session_id": session_id,
+            "name": rec["name"],
+            "artist": rec.get("artist") or [],
+            "norm_key": recommendation_key(rec["name"], rec.get("artist")),
+            "spotify_id": rec["spotify_id"],
+            "image_url": rec.get("image_url"),
+            "created_at": now,
+        }
+        for rec in candidates
+    ]
+    if not rows:
+        return
+    db.session.execute(_dialect_insert(Candidate).on_conflict_do_nothing(), rows)
+
+
+def _delete_candidates(session_id, ids):
+    """Deletes these buffered candidates (get_candidates row ids). No commit."""
+    if ids:
+        Candidate.query.filter(Candidate.session_id == session_id, Candidate.id.in_(list(ids))) \
+            .delete(synchronize_session=False)
+
+
+@timed_db
+def get_candidates(session_id, max_age_seconds):
+    """
+    Reads the session's candidate buffer, oldest first, without emptying it: the batch they are
+    offered to deletes them when it is recorded (store_gemini_recommendations / finish_job), so a
+    batch that fails or is abandoned midway leaves the buffer as it was.
+    Candidates older than max_age_seconds are left out; their ids are returned for that delete too.
+
+    Returns:
+        (list, list): the candidates, and the row ids to delete once the batch is recorded
+    """
+    cutoff = time.time() - max_age_seconds
+    rows = Candidate.query.filter_by(session_id=session_id).order_by(Candidate.id).all()
+    fresh = [
+        {"name": row.name, "artist": row.artist, "spotify_id": row.spotify_id, "image_url": row.image_url}
+        for row in rows if row.created_at >= cutoff
+    ]
+    return fresh, [row.id for row in rows]
+
+
+@timed_db
+def get_cached_entries(source, spotify_ids):
+    """Returns {spotify_id: (payload, fetched_at)} for the ids present in the track cache"""
+    found = {}
+    ids = list(spotify_ids)
+    # stay well under SQLite's bound-parameter limit
+    for i in range(0, len(ids), 500):
+        rows = TrackCacheEntry.query.filter(
+            TrackCacheEntry.source == source,
+            TrackCacheEntry.spotify_id.in_(ids[i:i + 500]),
+        ).all()
+        for row in rows:
+            found[row.spotify_id] = (row.payload, row.fetched_at)
+    return found
 
-        db.session.add(recommendation)
+
+@timed_db
+@retry_on_lock
+def put_cached_entries(source, entries, fetched_at):
+    """Writes {spotify_id: payload} to the track cache in one upsert, replacing old rows"""
+    # sorted, so concurrent writers lock rows in the same order (no PostgreSQL deadlocks)
+    rows = [
+        {"source": source, "spotify_id": spotify_id, "payload": payload, "fetched_at": fetched_at}
+        for spotify_id, payload in sorted(entries.items())
+    ]
+    if not rows:
+        return
+    stmt = _dialect_insert(TrackCacheEntry)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["source", "spotify_id"],
+        set_={"payload": stmt.excluded.payload, "fetched_at": stmt.excluded.fetched_at},
+    )
+    db.session.execute(stmt, rows)
+    db.session.commit()
+
+
+def _job_dict(job):
+    return {
+        "job_id": job.id,
+        "session_id": job.session_id,
+        "status": job.status,
+        "recommendations": job.result,
+        "error": job.error,
+    }
+
+
+@timed_db
+@retry_on_lock
+def create_job(session_id):
+    job = Job(id=uuid.uuid4().hex, session_id=session_id, status="queued", created_at=time.time())
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+@timed_db
+def get_job(job_id):
+    """The job as a dict, re-read from the database (workers update it from other threads)"""
+    job = db.session.get(Job, job_id, populate_existing=True)
+    return _job_dict(job) if job is not None else None
+
+
+@timed_db
+@retry_on_lock
+def set_job_status(job_id, status, error=None):
+    """running / failed; a job's batch is stored by finish_job"""
+    values = {"status": status}
+    if status == "failed":
+        values.update(error=error, finished_at=time.time())
+    Job.query.filter_by(id=job_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+@timed_db
+@retry_on_lock
+def finish_job(job_id, session_id, result, candidates, taken=()):
+    """
+    Stores a job's batch, deletes the buffered candidates it read (taken, get_candidates row ids)
+    and buffers the ones it left over, in one transaction. Returns False (and writes nothing) when
+    the job row is gone - /clear ran meanwhile, so its output belongs to seeds and history that no
+    longer exist. The batch only enters the history once take_job serves it.
+    """
+    finished = Job.query.filter_by(id=job_id, status="running").update(
+        {"status": "done", "result": result, "finished_at": time.time()}, synchronize_session=False,
+    )
+    if finished:
+        _delete_candidates(session_id, taken)
+        _insert_candidates(session_id, candidates)
+    db.session.commit()
+    return bool(finished)
+
+
+@timed_db
+def get_open_job(session_id, max_age_seconds):
+    """
+    The session's newest job that is still coming or ready to serve, or None.
+    queued / running jobs older than max_age_seconds are treated as lost (e.g. the worker restarted).
+    """
+    cutoff = time.time() - max_age_seconds
+    job = (
+        Job.query
+        .filter(Job.session_id == session_id)
+        .filter(db.or_(Job.status == "done", db.and_(Job.status.in_(("queued", "running")), Job.created_at >= cutoff)))
+        .order_by(Job.created_at.desc())
+        .execution_options(populate_existing=True)
+        .first()
+    )
+    return _job_dict(job) if job is not None else None
+
+
+@timed_db
+def pending_recommendations(session_id):
+    """
+    The batches of the session's done jobs nobody has taken yet. They aren't in its history until
+    served, but are already spoken for: other batches must not repeat them.
+    """
+    jobs = Job.query.filter_by(session_id=session_id, status="done") \
+        .execution_options(populate_existing=True).all()
+    return [rec for job in jobs for rec in job.result or []]
+
+
+@timed_db
+@retry_on_lock
+def take_job(job_id):
+    """
+    Marks a done job as served, records its batch in the session's history and returns it; None if
+    it isn't done (or another request got it first - the status check and update are one statement).
+    Tracks the session was recommended while the batch waited (by a request that didn't wait for it)
+    are dropped from it.
+    """
+    taken = Job.query.filter_by(id=job_id, status="done").update({"status": "served"}, synchronize_session=False)
+    if not taken:
+        db.session.commit()
+        return None
+    job = db.session.get(Job, job_id, populate_existing=True)
+    recs = job.result or []
+    keys = [recommendation_key(rec["name"], rec.get("artist")) for rec in recs]
+    seen_keys = _present(Recommendation.norm_key, job.session_id, keys)
+    seen_ids = _present(Recommendation.spotify_id, job.session_id, [rec.get("spotify_id") for rec in recs])
+    job.result = [
+        rec for rec, key in zip(recs, keys)
+        if key not in seen_keys and rec.get("spotify_id") not in seen_ids
+    ]
+    _insert_recommendations(job.session_id, job.result)
     db.session.commit()
-    return len(recommended_songs)
+    return job.result
+
 
+@timed_db
+@retry_on_lock
+def apply_feedback(session_id, events, update):
+    """
+    Records swipe events and folds the new ones into the session's taste profile, in one transaction.
+    events: [{"spotify_id", "liked", "weight"}]; update(stats or None, new_events) -> new stats.
+    Tracks the session already swiped are ignored, so resending a batch changes nothing.
 
-def get_recommendations():
-    """Get all recommendations for user display"""
-    recommended_data = []
-    for rec in Recommendation.query.all():
-        recommended_data.append({
-            "name": rec.name,
-            "artist": rec.artist,
+    Returns:
+        (int, dict | None): how many events were new, and the profile's stats
+    """
+    now = time.time()
+    rows = {}
+    for swipe in events:
+        rows.setdefault(swipe["spotify_id"], {
+            "session_id": session_id,
+            "spotify_id": swipe["spotify_id"],
+            "liked": bool(swipe["liked"]),
+            "weight": swipe.get("weight", 1.0),
+            "created_at": now,
         })
-    return recommended_data
+    if not rows:
+        return 0, get_taste_profile(session_id)
+
+    # the insert takes SQLite's write lock, the FOR UPDATE PostgreSQL's row lock:
+    # concurrent batches for a session are applied one after the other
+    inserted = set(db.session.scalars(
+        _dialect_insert(Feedback).on_conflict_do_nothing().returning(Feedback.spotify_id),
+        list(rows.values()),
+    ))
+    if not inserted:
+        db.session.commit()
+        return 0, get_taste_profile(session_id)
+    db.session.execute(
+        _dialect_insert(SessionTaste).on_conflict_do_nothing(),
+        [{"session_id": session_id, "stats": None, "updated_at": now}],
+    )
+    taste = db.session.get(SessionTaste, session_id, with_for_update=True, populate_existing=True)
+    taste.stats = update(taste.stats, [row for spotify_id, row in rows.items() if spotify_id in inserted])
+    taste.updated_at = now
+    db.session.commit()
+    return len(inserted), taste.stats
 
 
-def get_song_count():
-    """Get total number of songs in database"""
-    return Song.query.count()
+@timed_db
+def get_taste_profile(session_id):
+    """The session's taste profile stats, or None before its first swipe"""
+    taste = db.session.get(SessionTaste, session_id, populate_existing=True)
+    return taste.stats if taste is not None else None
+
+
+def get_song_count(session_id=None):
+    """Get number of songs in a session, or in the whole database"""
+    if session_id is None:
+        return Song.query.count()
+    return Song.query.filter_by(session_id=session_id).count()
+
+
+@timed_db
+@retry_on_lock
+def clear_session(session_id):
+    """Clear one session's songs, recommendations, candidates, jobs and feedback (the session itself is kept)"""
+    Recommendation.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+    Job.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+    Feedback.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+    Candidate.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+    SessionTaste.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+    Song.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+    db.session.commit()
+    return "Session cleared"
 
 
+@retry_on_lock
 def clear_all_data():
     """Clear all data from all tables (useful for testing)"""
     Recommendation.query.delete()
     Song.query.delete()
+    Job.query.delete()
+    Feedback.query.delete()
+    Candidate.query.delete()
+    SessionTaste.query.delete()
+    UserSession.query.delete()
     db.session.commit()
     return "All data cleared"
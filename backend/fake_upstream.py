@@ -0,0 +1,253 @@
+"""
+Local stand-in for Spotify, Recco and Gemini, for benchmarks and load tests without network access.
+
+    python fake_upstream.py --port 8099 --latency-ms 20 --error-rate 0.01
+
+prints the environment variables that point the backend at it. Everything is deterministic:
+playlist "<size>-<variant>" has `size` tracks, track ids encode their position, audio features
+are derived from the id, and searches always find a track.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+PAGE_SIZE = 100
+
+
+def track_id(prefix, n):
+    """22-char Spotify-shaped id; the prefix keeps different playlists / searches apart"""
+    return f"{prefix}{n:0{22 - len(prefix)}d}"
+
+
+def playlist_prefix(variant):
+    """Track id prefix of playlist "<size>-<variant>"; its tracks are track_id(prefix, 0..size-1)"""
+    return "P" + re.sub(r"[^0-9A-Za-z]", "", variant or "0")[:8]
+
+
+def track_object(spotify_id):
+    n = zlib.crc32(spotify_id.encode())
+    return {
+        "id": spotify_id,
+        "name": f"Track {spotify_id[-6:]}",
+        "artists": [{"name": f"Artist {n % 500}"}],
+        "album": {"images": [
+            {"height": 640, "width": 640, "url": f"https://img.example/{spotify_id}/640"},
+            {"height": 300, "width": 300, "url": f"https://img.example/{spotify_id}/300"},
+        ]},
+    }
+
+
+def audio_features(spotify_id):
+    rng = random.Random(zlib.crc32(spotify_id.encode()))
+    return {
+        "id": "r" + spotify_id,
+        "href": f"https://api.reccobeats.com/v1/track/r{spotify_id}",
+        "tempo": round(rng.uniform(70, 180), 3),
+        "danceability": round(rng.random(), 3),
+        "energy": round(rng.random(), 3),
+        "valence": round(rng.random(), 3),
+        "acousticness": round(rng.random(), 3),
+        "instrumentalness": round(rng.random() ** 3, 3),
+        "liveness": round(rng.random() / 2, 3),
+        "loudness": round(rng.uniform(-20, -2), 3),
+        "speechiness": round(rng.random() / 4, 3),
+        "key": rng.randrange(12),
+        "mode": rng.randrange(2),
+        "time_signature": 4,
+    }
+
+
+class FakeUpstreams:
+    """
+    Threaded HTTP server answering the Spotify, Spotify accounts, Recco and Gemini calls the backend makes.
+    latency / jitter are seconds added to every response (gemini_latency for Gemini);
+    error_rate and throttle_rate are the share of responses turned into 500s and 429s.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.02, jitter=0.005, gemini_latency=0.5,
+                 error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.gemini_latency = gemini_latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.requests = Counter()  # (upstream, status) -> count
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._gemini_calls = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        """Environment variables pointing config.py at this server"""
+        return {
+            "SPOTIFY_API_URL": f"{self.url}/spotify/v1",
+            "SPOTIFY_ACCOUNTS_URL": f"{self.url}/accounts/api/token",
+            "RECCO_API_URL": f"{self.url}/recco/v1",
+            "GEMINI_BASE_URL": f"{self.url}/gemini/",
+            # anything non-empty: the fakes don't check credentials
+            "SPOTIFY_CLIENT_ID": "fake",
+            "SPOTIFY_CLIENT_SECRET": "fake",
+            "GEMINI_API_KEY": "fake",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # --- behaviour
+
+    def _fault(self):
+        """None, or the status (500 / 429) this response should fail with"""
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.error_rate:
+            return 500
+        if roll < self.error_rate + self.throttle_rate:
+            return 429
+        return None
+
+    def _delay(self, base):
+        with self._lock:
+            extra = self._rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        time.sleep(max(0.0, base + extra))
+
+    def route(self, method, path, query, body):
+        """Returns (upstream, status, payload)"""
+        if path.startswith("/accounts/"):
+            return "spotify_token", 200, {"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600}
+        if path.startswith("/spotify/v1/"):
+            return ("spotify",) + self._spotify(path[len("/spotify/v1/"):], query)
+        if path.startswith("/recco/v1/"):
+            return ("recco",) + self._recco(path[len("/recco/v1/"):], query)
+        if path.startswith("/gemini/") and method == "POST":
+            return ("gemini",) + self._gemini(body)
+        return "unknown", 404, {"error": "not found"}
+
+    def _spotify(self, path, query):
+        if path == "tracks":
+            ids = query.get("ids", [""])[0].split(",")
+            return 200, {"tracks": [track_object(i) for i in ids if i]}
+        if path.startswith("tracks/"):
+            return 200, track_object(path.split("/", 1)[1])
+        if path == "search":
+            q = unquote(query.get("q", [""])[0])
+            found = track_id("S", zlib.crc32(q.encode()))
+            return 200, {"tracks": {"items": [track_object(found)]}}
+        match = re.fullmatch(r"playlists/(\d+)-?(\w*)/tracks", path)
+        if match:
+            size, variant = int(match.group(1)), match.group(2) or "0"
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", [str(PAGE_SIZE)])[0])
+            prefix = playlist_prefix(variant)
+            items = [{"track": track_object(track_id(prefix, n))} for n in range(offset, min(offset + limit, size))]
+            nxt = None
+            if offset + limit < size:
+                nxt = f"{self.url}/spotify/v1/{path}?limit={limit}&offset={offset + limit}"
+            return 200, {"items": items, "next": nxt}
+        return 404, {"error": {"status": 404, "message": "not found"}}
+
+    def _recco(self, path, query):
+        if path == "track":
+            ids = query.get("ids", [""])[0].split(",")
+            return 200, {"content": [
+                {"id": "r" + i, "href": f"https://open.spotify.com/track/{i}"} for i in ids if i
+            ]}
+        match = re.fullmatch(r"track/r(\w+)/audio-features", path)
+        if match:
+            return 200, audio_features(match.group(1))
+        return 404, {"error": "not found"}
+
+    def _gemini(self, body):
+        prompt = json.loads(body or b"{}")["contents"][0]["parts"][0]["text"]
+        match = re.search(r"EXACTLY (\d+)", prompt)
+        count = int(match.group(1)) if match else 10
+        with self._lock:
+            self._gemini_calls += 1
+            call = self._gemini_calls
+        recs = [{"name": f"Suggestion {call}-{i}", "artist": [f"Artist {(call * 7 + i) % 500}"]} for i in range(count)]
+        text = "```json\n" + json.dumps(recs) + "\n```"
+        return 200, {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}]}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real upstreams
+
+            def _serve(self, method):
+                parts = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                upstream, status, payload = fake.route(method, parts.path, parse_qs(parts.query), body)
+                fault = fake._fault() if upstream != "spotify_token" else None
+                fake._delay(fake.gemini_latency if upstream == "gemini" else fake.latency)
+                headers = {}
+                if fault is not None:
+                    status, payload = fault, {"error": {"status": fault, "message": "injected"}}
+                    if fault == 429:
+                        headers["Retry-After"] = "0"
+                with fake._lock:
+                    fake.requests[(upstream, status)] += 1
+                out = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(out)
+
+            def do_GET(self):
+                self._serve("GET")
+
+            def do_POST(self):
+                self._serve("POST")
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--gemini-latency-ms", type=float, default=500)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeUpstreams(args.host, args.port, args.latency_ms / 1000, args.jitter_ms / 1000,
+                         args.gemini_latency_ms / 1000, args.error_rate, args.throttle_rate).start()
+    for name, value in fake.env().items():
+        print(f"export {name}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+
+from api_client import call_with_retries, gemini_breaker
+from cache import LRUCache
+from metrics import record_cache
+from config import GEMINI_API_KEY, GEMINI_MODEL, GEMINI_BASE_URL, GEMINI_CACHE_TTL, GEMINI_CACHE_SIZE
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The shared genai.Client (keeps its HTTP connection pool across calls)."""
+    global _client
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY is not set")
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google import genai  # slow import, only pay for it on the first Gemini call
+                http_options = {"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None
+                _client = genai.Client(api_key=GEMINI_API_KEY, http_options=http_options)
+    return _client
+
+
+def generate(prompt: str):
+    """One Gemini call (retried, behind the gemini circuit breaker). Returns the response text."""
+    client = get_client()
+    return call_with_retries(
+        lambda: client.models.generate_content(model=GEMINI_MODEL, contents=prompt).text,
+        gemini_breaker,
+    )
+
+
+async def agenerate(prompt: str):
+    """
+    generate() for async views, on a worker thread. Not the SDK's asyncio client: its connection
+    pool is bound to the event loop it first ran on, and EventLoopPool runs one loop per thread;
+    the sync client's pool is shared by all of them.
+    """
+    return await asyncio.to_thread(generate, prompt)
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResponseCache:
+    """
+    LRU + TTL memo of Gemini answers keyed by prompt.cache_key, with in-flight coalescing:
+    while one thread is waiting on Gemini for a key, other threads asking for the same
+    key wait for that answer instead of sending their own request.
+    Failures are not cached; every waiter sees the leader's exception.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.ttl = ttl
+        self._lru = LRUCache(maxsize)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    def _claim(self, key):
+        """(True, cached value, None) on a hit, else (False, the in-flight call, whether we lead it)"""
+        hit, value = self._lru.get(key)
+        with self._lock:
+            if not hit:
+                # re-check under the lock: a leader may have just finished
+                hit, value = self._lru.get(key)
+            if hit:
+                self._count("hits")
+                return True, value, None
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = self._inflight[key] = _InFlight()
+                self._count("misses")
+                return False, flight, True
+            self._count("coalesced")
+            return False, flight, False
+
+    def _count(self, field):
+        # called with self._lock held
+        self._stats[field] += 1
+        record_cache("gemini", "response", field)
+
+    def _settle(self, key, flight, result=None, error=None):
+        if error is None:
+            flight.result = result
+            self._lru.set(key, result, time.time() + self.ttl)
+        else:
+            flight.error = error
+        with self._lock:
+            del self._inflight[key]
+        flight.done.set()
+
+    @staticmethod
+    def _outcome(flight):
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def get_or_call(self, key, fn):
+        hit, found, leader = self._claim(key)
+        if hit:
+            return found
+        flight = found
+        if not leader:
+            flight.done.wait()
+            return self._outcome(flight)
+        try:
+            result = fn()
+        except BaseException as e:
+            self._settle(key, flight, error=e)
+            raise
+        self._settle(key, flight, result)
+        return result
+
+    async def aget_or_call(self, key, coro_fn):
+        """get_or_call for coroutine functions; shares entries and in-flight calls with the sync path"""
+        hit, found, leader = self._claim(key)
+        if hit:
+            return found
+        flight = found
+        if not leader:
+            # the leader may be on another thread's loop, so wait without blocking ours
+            await asyncio.to_thread(flight.done.wait)
+            return self._outcome(flight)
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self._settle(key, flight, error=e)
+            raise
+        self._settle(key, flight, result)
+        return result
+
+    def clear(self):
+        self._lru.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["size"] = len(self._lru)
+        return stats
+
+
+response_cache = ResponseCache(GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL)
+
+
+def cached_generate(key: str, prompt: str, parse):
+    """
+    parse(generate(prompt)), memoized and coalesced on key (see prompt.cache_key).
+    Only parsed answers are cached: when parse raises, so does this call, and the next one
+    with the same key asks Gemini again.
+    """
+    return response_cache.get_or_call(key, lambda: parse(generate(prompt)))
+
+
+async def acached_generate(key: str, prompt: str, parse):
+    """cached_generate() for async views"""
+    async def call():
+        return parse(await agenerate(prompt))
+
+    return await response_cache.aget_or_call(key, call)
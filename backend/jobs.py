@@ -0,0 +1,67 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from db import create_job, db, finish_job, get_job, get_open_job, set_job_status
+
+
+class JobQueue:
+    """
+    Local worker pool that generates recommendation batches in the background.
+    Job state lives in the jobs table, so any request (or process) can poll it;
+    the futures kept here only let a request in this process wait on a job without polling.
+    Each job runs in its own app context.
+    """
+
+    def __init__(self, app, max_workers, timeout):
+        self.app = app
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="spinder-job")
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, fn):
+        """
+        Queues fn(session_id) -> (JSON result, leftover candidates, ids of the buffered candidates
+        it read) as a job, unless the session already has one coming or waiting to be served.
+        Returns the job id either way. fn must not write its result anywhere itself: finish_job
+        stores it, unless the session was cleared while the job ran.
+        """
+        with self._lock:
+            job = get_open_job(session_id, self.timeout)
+            if job is not None:
+                return job["job_id"]
+            job_id = create_job(session_id)
+            self._futures[job_id] = self._pool.submit(self._run, job_id, session_id, fn)
+        return job_id
+
+    def _run(self, job_id, session_id, fn):
+        try:
+            with self.app.app_context():
+                set_job_status(job_id, "running")
+                try:
+                    result, candidates, taken = fn(session_id)
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception("job %s for session %s failed", job_id, session_id)
+                    set_job_status(job_id, "failed", error=str(e))
+                    return
+                if not finish_job(job_id, session_id, result, candidates, taken):
+                    self.app.logger.info("job %s: session %s was cleared meanwhile, batch dropped", job_id, session_id)
+        finally:
+            with self._lock:
+                self._futures.pop(job_id, None)
+
+    def wait(self, job_id, timeout):
+        """Blocks until the job is no longer queued / running, or timeout seconds pass"""
+        future = self._futures.get(job_id)
+        if future is not None:
+            wait([future], timeout=timeout)
+            return
+        # running in another process: poll the table
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = get_job(job_id)
+            if job is None or job["status"] not in ("queued", "running"):
+                return
+            time.sleep(0.2)
@@ -0,0 +1,441 @@
+"""
+Load test / soak test for the HTTP API. Virtual users, each with its own session, loop over
+GET /link/<playlist>, POST /songids (liking a few cards of the last batch) and now and then
+POST /clear, while concurrency ramps up stage by stage:
+
+    python loadtest.py --stages 1,5,10,25,50 --duration 20 --json load.json
+    python loadtest.py --stages 50 --soak 600 --window 30      # hold 50 users for 10 minutes
+
+By default the app is served in-process (threaded werkzeug server, fresh SQLite database)
+against fake_upstream.py. --url targets a server that is already running instead; start it
+against `python fake_upstream.py` (with the variables it prints exported) so playlists
+and seeds are the ones the checks expect.
+
+Besides latency (p50/p95/p99 per endpoint), throughput and error rates, every response is checked:
+a non-empty batch of at most BATCH_SIZE well-formed cards, its own X-Session-ID echoed back,
+no seed track and nothing the session was already served (since its last /clear), an empty
+history right after /clear, and at the end of each stage the session's GET /history matching
+what it was served. Users share a few playlists so sessions contend on the same Song rows.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+import requests
+
+from benchmark import percentile
+from fake_upstream import FakeUpstreams, playlist_prefix, track_id
+
+ENDPOINTS = ("link", "songids", "clear", "history")
+MAX_FAILURE_SAMPLES = 20
+
+
+class Failure(Exception):
+    """A response that came back but is wrong"""
+
+
+class Recorder:
+    """Thread-safe sample sink for one stage"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.samples = []  # (endpoint, seconds since stage start, latency, outcome)
+        self.failures = Counter()  # "<endpoint>: <kind>" -> count
+        self.failure_samples = []
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, started, latency, outcome):
+        with self._lock:
+            self.samples.append((endpoint, started - self.started, latency, outcome))
+
+    def fail(self, endpoint, kind, detail):
+        with self._lock:
+            self.failures[f"{endpoint}: {kind}"] += 1
+            if len(self.failure_samples) < MAX_FAILURE_SAMPLES:
+                self.failure_samples.append(f"{endpoint}: {detail}")
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {}
+    return {
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies) * 1000, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1),
+    }
+
+
+def summarize(samples, wall):
+    """Request counts, outcomes, throughput and latency percentiles of (endpoint, t, latency, outcome) samples"""
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample[0]].append(sample)
+    errors = sum(1 for s in samples if s[3] == "error")
+    report = {
+        "requests": len(samples),
+        "errors": errors,
+        "check_failures": sum(1 for s in samples if s[3] == "bad"),
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput_rps": round(len(samples) / wall, 2) if wall else None,
+        **latency_summary([s[2] for s in samples]),
+        "endpoints": {},
+    }
+    for endpoint in ENDPOINTS:
+        rows = by_endpoint.get(endpoint)
+        if rows:
+            outcomes = Counter(s[3] for s in rows)
+            report["endpoints"][endpoint] = {
+                "requests": len(rows),
+                "errors": outcomes["error"],
+                "check_failures": outcomes["bad"],
+                "throughput_rps": round(len(rows) / wall, 2) if wall else None,
+                **latency_summary([s[2] for s in rows]),
+            }
+    return report
+
+
+class VirtualUser:
+    """One session: link a playlist, swipe through a few /songids batches, sometimes start over"""
+
+    def __init__(self, test, recorder, session_id, variant, rng):
+        self.test = test
+        self.args = test.args
+        self.recorder = recorder
+        self.session_id = session_id
+        self.playlist = f"{self.args.playlist_size}-{variant}"
+        self.playlist_seeds = {track_id(playlist_prefix(variant), n) for n in range(self.args.playlist_size)}
+        self.rng = rng
+        self.http = requests.Session()
+        self.http.headers["X-Session-ID"] = session_id
+        self.reset()
+
+    def reset(self):
+        self.linked = False
+        self.seeds = set()
+        self.served = set()
+        self.last_batch = []
+
+    def request(self, endpoint, method, path, **kwargs):
+        """
+        One timed request. Returns the response, or None after a transport error / non-200
+        (recorded as an error). The caller records check failures with bad().
+        """
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.test.url + path, timeout=self.args.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.recorder.add(endpoint, started, time.perf_counter() - started, "error")
+            self.recorder.fail(endpoint, type(e).__name__, f"{self.session_id} {method} {path}: {e!r}")
+            return None
+        latency = time.perf_counter() - started
+        if response.status_code != 200:
+            self.recorder.add(endpoint, started, latency, "error")
+            self.recorder.fail(endpoint, f"HTTP {response.status_code}",
+                               f"{self.session_id} {method} {path}: HTTP {response.status_code} {response.text[:200]}")
+            return None
+        if response.headers.get("X-Session-ID") != self.session_id:
+            self.bad(endpoint, started, latency, "session header",
+                     f"sent {self.session_id}, got {response.headers.get('X-Session-ID')!r}")
+            return None
+        response.started, response.latency = started, latency
+        return response
+
+    def bad(self, endpoint, started, latency, kind, detail):
+        self.recorder.add(endpoint, started, latency, "bad")
+        self.recorder.fail(endpoint, kind, f"{self.session_id}: {detail}")
+
+    def check_batch(self, endpoint, response):
+        """Checks one /link or /songids batch against what the session has seen so far"""
+        try:
+            batch = response.json()
+            if not isinstance(batch, list):
+                raise Failure("shape", f"expected a list, got {type(batch).__name__}")
+            if not batch:
+                raise Failure("empty batch", "no recommendations")
+            if len(batch) > self.test.batch_size:
+                raise Failure("oversized batch", f"{len(batch)} cards, BATCH_SIZE is {self.test.batch_size}")
+            ids = []
+            for card in batch:
+                if not (isinstance(card, dict) and isinstance(card.get("name"), str)
+                        and isinstance(card.get("artist"), list) and card.get("spotify_id") and card.get("image_url")):
+                    raise Failure("malformed card", repr(card)[:200])
+                ids.append(card["spotify_id"])
+            duplicates = [i for i, n in Counter(ids).items() if n > 1]
+            if duplicates:
+                raise Failure("duplicate in batch", duplicates[:5])
+            seeds = (self.playlist_seeds if self.linked else set()) | self.seeds
+            if seeds.intersection(ids):
+                raise Failure("seed recommended", sorted(seeds.intersection(ids))[:5])
+            if self.served.intersection(ids):
+                raise Failure("repeat", sorted(self.served.intersection(ids))[:5])
+        except (Failure, ValueError) as e:
+            kind, detail = e.args if isinstance(e, Failure) else ("invalid json", repr(e))
+            self.bad(endpoint, response.started, response.latency, kind, detail)
+            return False
+        self.recorder.add(endpoint, response.started, response.latency, "ok")
+        self.served.update(ids)
+        self.last_batch = ids
+        return True
+
+    def link(self):
+        response = self.request("link", "GET", f"/link/{self.playlist}")
+        self.linked = True  # the seeds are in even when the response is bad
+        if response is not None:
+            self.check_batch("link", response)
+
+    def songids(self):
+        liked = self.rng.sample(self.last_batch, min(self.args.likes, len(self.last_batch)))
+        response = self.request("songids", "POST", "/songids", json=liked)
+        self.seeds.update(liked)
+        if response is not None:
+            self.check_batch("songids", response)
+
+    def clear(self):
+        response = self.request("clear", "POST", "/clear")
+        if response is None:
+            return
+        self.recorder.add("clear", response.started, response.latency, "ok")
+        self.reset()
+        response = self.request("history", "GET", "/history")
+        if response is None:
+            return
+        items = response.json().get("items")
+        if items:
+            self.bad("history", response.started, response.latency, "not cleared",
+                     f"{len(items)} recommendations right after /clear")
+        else:
+            self.recorder.add("history", response.started, response.latency, "ok")
+
+    def verify_history(self):
+        """The session's whole /history against what it was served since its last /clear"""
+        stored = []
+        cursor = None
+        while True:
+            params = {"limit": 200, **({"cursor": cursor} if cursor is not None else {})}
+            response = self.request("history", "GET", "/history", params=params)
+            if response is None:
+                return
+            page = response.json()
+            stored += [item["spotify_id"] for item in page["items"]]
+            cursor = page.get("next_cursor")
+            if cursor is None:
+                break
+        duplicates = [i for i, n in Counter(stored).items() if n > 1]
+        missing = self.served - set(stored)
+        extra = set(stored) - self.served
+        if duplicates or missing or extra:
+            self.bad("history", response.started, response.latency, "history mismatch",
+                     f"{len(missing)} served but not stored, {len(extra)} stored but not served, "
+                     f"{len(duplicates)} stored twice")
+        else:
+            self.recorder.add("history", response.started, response.latency, "ok")
+
+    def run(self, deadline):
+        while time.perf_counter() < deadline:
+            self.link()
+            for _ in range(self.args.songids_per_link):
+                if time.perf_counter() >= deadline or not self.last_batch:
+                    break
+                self.songids()
+            if self.rng.random() < self.args.clear_rate:
+                self.clear()
+        self.verify_history()
+        self.http.close()
+
+
+class LoadTest:
+    def __init__(self, args, fake=None):
+        self.args = args
+        self.fake = fake
+        self.results = []
+        self._run = f"{int(time.time()):x}"
+        self._stages = itertools.count()
+        if args.url:
+            self.url = args.url.rstrip("/")
+            self.batch_size = args.batch_size or 10
+            self.server = None
+        else:
+            self._serve_in_process()
+
+    def _serve_in_process(self):
+        # config.py reads the environment on import, so the app is only imported now
+        from flask.logging import default_handler
+        from werkzeug.serving import make_server
+        import app as app_module
+        import config
+
+        flask_app = app_module.create_app()
+        # no per-request timing / access log lines on stderr
+        flask_app.logger.removeHandler(default_handler)
+        flask_app.logger.setLevel(logging.WARNING)
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.server = make_server("127.0.0.1", 0, flask_app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.batch_size = config.BATCH_SIZE
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    def _db_retries(self):
+        """spinder_db_retries_total summed over ops, or None when /metrics can't be read"""
+        try:
+            text = requests.get(self.url + "/metrics", timeout=self.args.timeout).text
+        except requests.RequestException:
+            return None
+        return sum(float(m) for m in re.findall(r"^spinder_db_retries_total(?:\{[^}]*\})? (\S+)$", text, re.M))
+
+    def _upstream_calls(self, before):
+        calls = {}
+        for (upstream, status), count in dict(self.fake.requests).items():
+            delta = count - before.get((upstream, status), 0)
+            if delta:
+                calls[f"{upstream}:{status}"] = delta
+        return calls
+
+    def stage(self, concurrency, duration, soak=False):
+        """`concurrency` users for `duration` seconds; each then checks its history"""
+        n = next(self._stages)
+        recorder = Recorder()
+        retries_before = self._db_retries()
+        upstream_before = dict(self.fake.requests) if self.fake else None
+        deadline = time.perf_counter() + duration
+        users = [
+            VirtualUser(self, recorder, f"load-{self._run}-{n}-{u}", f"v{u % self.args.playlists}",
+                        random.Random(self.args.seed * 1000003 + n * 1009 + u))
+            for u in range(concurrency)
+        ]
+        threads = [threading.Thread(target=user.run, args=(deadline,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - recorder.started
+
+        result = {
+            "stage": n,
+            "concurrency": concurrency,
+            "duration_s": round(wall, 2),
+            **summarize(recorder.samples, wall),
+            "failures": dict(recorder.failures),
+            "failure_samples": recorder.failure_samples,
+        }
+        retries_after = self._db_retries()
+        if retries_before is not None and retries_after is not None:
+            result["db_retries"] = int(retries_after - retries_before)
+        if self.fake:
+            result["upstream_calls"] = self._upstream_calls(upstream_before)
+        if soak:
+            # per-window numbers, so drift over a long run (latency creep, growing error rate) shows up
+            windows = defaultdict(list)
+            for sample in recorder.samples:
+                windows[int(sample[1] // self.args.window)].append(sample)
+            result["windows"] = [
+                {"start_s": w * self.args.window, **summarize(rows, self.args.window)}
+                for w, rows in sorted(windows.items())
+            ]
+        result["ok"] = result["error_rate"] <= self.args.max_error_rate and not result["check_failures"]
+        self.results.append(result)
+        self.print_result(result, "soak" if soak else "ramp")
+        return result
+
+    @staticmethod
+    def print_result(result, kind):
+        link = result["endpoints"].get("link", {})
+        print(f"{kind:<5} {result['concurrency']:>5} users {result['duration_s']:>7.1f} s {result['requests']:>7} req "
+              f"{result['throughput_rps'] or 0:>8.1f} req/s  /link p50={link.get('p50_ms')} p95={link.get('p95_ms')} "
+              f"p99={link.get('p99_ms')} ms  errors={result['error_rate']:.2%}  bad={result['check_failures']}"
+              f"  db_retries={result.get('db_retries')}  {'ok' if result['ok'] else 'FAIL'}", flush=True)
+        for sample in result["failure_samples"][:5]:
+            print(f"      {sample}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", default="1,5,10,25,50", help="concurrent users per ramp stage, comma separated")
+    parser.add_argument("--duration", type=float, default=15, help="seconds per ramp stage")
+    parser.add_argument("--soak", type=float, default=0,
+                        help="after the ramp, hold the last stage's concurrency this many seconds")
+    parser.add_argument("--window", type=float, default=30, help="soak report window, seconds")
+    parser.add_argument("--playlist-size", type=int, default=50)
+    parser.add_argument("--playlists", type=int, default=4, help="distinct playlists shared by the users")
+    parser.add_argument("--songids-per-link", type=int, default=3, help="/songids batches after each /link")
+    parser.add_argument("--likes", type=int, default=3, help="cards of the last batch sent to /songids")
+    parser.add_argument("--clear-rate", type=float, default=0.2, help="chance of a /clear after each round")
+    parser.add_argument("--timeout", type=float, default=120, help="per-request timeout, seconds")
+    parser.add_argument("--max-error-rate", type=float, default=0.0, help="stages above this error rate fail")
+    parser.add_argument("--stop-on-failure", action="store_true", help="don't ramp past a failing stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="test this running server instead of an in-process one")
+    parser.add_argument("--batch-size", type=int, help="the server's BATCH_SIZE (only with --url; default 10)")
+    parser.add_argument("--database-url", help="in-process: DATABASE_URL to use instead of a fresh SQLite file")
+    parser.add_argument("--mode", default=None, help="in-process: RECOMMEND_MODE (gemini | rerank | local)")
+    parser.add_argument("--async-views", action="store_true", help="in-process: ASYNC_VIEWS=1")
+    parser.add_argument("--no-prefetch", action="store_true", help="in-process: PREFETCH_NEXT_BATCH=0")
+    parser.add_argument("--latency-ms", type=float, default=20, help="fake Spotify / Recco latency")
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--gemini-latency-ms", type=float, default=500)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of upstream responses that are 500s")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of upstream responses that are 429s")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--json", help="write the report here")
+    args = parser.parse_args()
+    stages = [int(s) for s in args.stages.split(",") if s]
+
+    fake = None
+    if not args.url:
+        fake = FakeUpstreams(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                             gemini_latency=args.gemini_latency_ms / 1000,
+                             error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=args.seed).start()
+        workdir = tempfile.mkdtemp(prefix="spinder-load-")
+        os.environ.update(fake.env())
+        os.environ.update({
+            "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(workdir, 'load.db')}",
+            "DB_MIGRATE": "reset",
+            "ASYNC_VIEWS": "1" if args.async_views else os.environ.get("ASYNC_VIEWS", "0"),
+            "DEBUG_PROMPTS": "0",
+        })
+        if args.mode:
+            os.environ["RECOMMEND_MODE"] = args.mode
+        if args.no_prefetch:
+            os.environ["PREFETCH_NEXT_BATCH"] = "0"
+        if not args.keep_rate_limits:
+            os.environ["RECCO_RATE_LIMIT"] = os.environ["SPOTIFY_RATE_LIMIT"] = "1000000"
+
+    test = LoadTest(args, fake)
+    print(f"target {test.url}  BATCH_SIZE={test.batch_size}  stages={stages}"
+          f"{f'  soak={args.soak:g}s' if args.soak else ''}", flush=True)
+    try:
+        for concurrency in stages:
+            if not test.stage(concurrency, args.duration)["ok"] and args.stop_on_failure:
+                break
+        else:
+            if args.soak and stages:
+                test.stage(stages[-1], args.soak, soak=True)
+    finally:
+        test.stop()
+        if fake:
+            fake.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "target": test.url, "batch_size": test.batch_size,
+                       "stages": test.results}, f, indent=2)
+    return 0 if test.results and all(r["ok"] for r in test.results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
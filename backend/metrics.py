@@ -0,0 +1,272 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from collections import defaultdict
+
+# Seconds; upstream calls and Gemini round trips both land somewhere in here
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, [('le', f'{bound:g}')])} {count}")
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {series[-2]:g}")
+                lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "spinder_stage_seconds", "Time spent in each recommendation pipeline stage", ["stage"])
+DB_SECONDS = Histogram(
+    "spinder_db_seconds", "Time spent in db.py helpers", ["op"])
+DB_RETRIES = Counter(
+    "spinder_db_retries_total", "db.py writes retried because the database was locked", ["op"])
+UPSTREAM_SECONDS = Histogram(
+    "spinder_upstream_seconds", "Latency of single upstream HTTP / SDK calls (one attempt)", ["upstream"])
+UPSTREAM_REQUESTS = Counter(
+    "spinder_upstream_requests_total", "Upstream call attempts by response status", ["upstream", "status"])
+UPSTREAM_RETRIES = Counter(
+    "spinder_upstream_retries_total", "Upstream retries by reason", ["upstream", "reason"])
+UPSTREAM_BYTES = Counter(
+    "spinder_upstream_response_bytes_total", "Response body bytes received from upstreams", ["upstream"])
+CACHE_LOOKUPS = Counter(
+    "spinder_cache_lookups_total", "Cache lookups by cache, source and result", ["cache", "source", "result"])
+HTTP_SECONDS = Histogram(
+    "spinder_http_request_seconds", "Time to serve each request (streams: until the body is sent)",
+    ["endpoint", "status"])
+
+REGISTRY = (
+    STAGE_SECONDS, DB_SECONDS, DB_RETRIES, UPSTREAM_SECONDS, UPSTREAM_REQUESTS, UPSTREAM_RETRIES,
+    UPSTREAM_BYTES, CACHE_LOOKUPS, HTTP_SECONDS,
+)
+
+
+def render():
+    """Every metric in the Prometheus text exposition format (0.0.4)"""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+class RequestTimings:
+    """
+    Per-request breakdown for the structured timing log: time per stage / db helper,
+    and calls / retries / bytes / time per upstream. Upstream time is summed over concurrent
+    calls, so it can exceed the request's wall time. Thread-safe, since the upstream calls
+    of one request are spread over worker threads (see bind).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sections = {"stages": defaultdict(float), "db": defaultdict(float)}
+        self._upstream = defaultdict(lambda: {"calls": 0, "retries": 0, "bytes": 0, "seconds": 0.0})
+
+    def add(self, section, name, seconds):
+        with self._lock:
+            self._sections[section][name] += seconds
+
+    def add_upstream(self, upstream, calls=0, retries=0, nbytes=0, seconds=0.0):
+        with self._lock:
+            totals = self._upstream[upstream]
+            totals["calls"] += calls
+            totals["retries"] += retries
+            totals["bytes"] += nbytes
+            totals["seconds"] += seconds
+
+    def as_dict(self):
+        def ms(seconds):
+            return round(seconds * 1000, 1)
+
+        with self._lock:
+            result = {section: {name: ms(s) for name, s in totals.items()} for section, totals in self._sections.items()}
+            result["upstream"] = {
+                name: {"calls": t["calls"], "retries": t["retries"], "bytes": t["bytes"], "ms": ms(t["seconds"])}
+                for name, t in self._upstream.items()
+            }
+        return result
+
+
+_current = contextvars.ContextVar("spinder_request_timings", default=None)
+
+
+def start_request():
+    """Starts collecting RequestTimings for the request on this thread / task"""
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def current():
+    return _current.get()
+
+
+def bind(fn):
+    """
+    Wraps fn so calls on pool threads report into the calling request's timings
+    (executor threads don't inherit context variables).
+    """
+    timings = _current.get()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current.set(timings)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return wrapper
+
+
+class _Timer:
+    """Context manager / decorator observing elapsed seconds into a histogram and the request's timings"""
+
+    def __init__(self, histogram, label, section, name):
+        self.histogram = histogram
+        self.label = label
+        self.section = section
+        self.name = name
+        self._started = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._started
+        self.histogram.observe(elapsed, **{self.label: self.name})
+        timings = _current.get()
+        if timings is not None:
+            timings.add(self.section, self.name, elapsed)
+        return False
+
+    def __call__(self, fn):
+        # a fresh timer per call, so recursive / concurrent calls don't share a start time
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with _Timer(self.histogram, self.label, self.section, self.name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Timer(self.histogram, self.label, self.section, self.name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+
+def timed_stage(name):
+    """with timed_stage("gemini"): ...  or  @timed_stage("recco_features")"""
+    return _Timer(STAGE_SECONDS, "stage", "stages", name)
+
+
+def timed_db(fn):
+    """Decorator for db.py helpers: DB_SECONDS labelled with the function name"""
+    return _Timer(DB_SECONDS, "op", "db", fn.__name__)(fn)
+
+
+class StageClock:
+    """
+    Times consecutive pipeline stages: start(name) closes the running stage and opens the next,
+    stop() closes the last one. Used by the generator pipelines, where stages can't be with-blocks.
+    """
+
+    def __init__(self):
+        self._stage = None
+        self._started = 0.0
+
+    def start(self, name):
+        self.stop()
+        self._stage = name
+        self._started = time.perf_counter()
+
+    def stop(self):
+        if self._stage is None:
+            return
+        elapsed = time.perf_counter() - self._started
+        STAGE_SECONDS.observe(elapsed, stage=self._stage)
+        timings = _current.get()
+        if timings is not None:
+            timings.add("stages", self._stage, elapsed)
+        self._stage = None
+
+
+def record_upstream(upstream, status, seconds, nbytes=0):
+    """One upstream call attempt; status is the HTTP status or an error class name"""
+    UPSTREAM_REQUESTS.inc(upstream=upstream, status=str(status))
+    UPSTREAM_SECONDS.observe(seconds, upstream=upstream)
+    if nbytes:
+        UPSTREAM_BYTES.inc(nbytes, upstream=upstream)
+    timings = _current.get()
+    if timings is not None:
+        timings.add_upstream(upstream, calls=1, nbytes=nbytes, seconds=seconds)
+
+
+def record_retry(upstream, reason):
+    UPSTREAM_RETRIES.inc(upstream=upstream, reason=reason)
+    timings = _current.get()
+    if timings is not None:
+        timings.add_upstream(upstream, retries=1)
+
+
+def record_cache(cache, source, result, n=1):
+    if n:
+        CACHE_LOOKUPS.inc(n, cache=cache, source=source, result=result)
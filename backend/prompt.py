@@ -0,0 +1,212 @@
+import hashlib
+import json
+from collections import Counter
+
+from config import PROMPT_TOKEN_BUDGET, PROMPT_TOP_ARTISTS, PROMPT_EXAMPLE_SEEDS, FEEDBACK_MIN_SHIFT
+
+
+NUMERIC_FEATURES = (
+    "tempo", "danceability", "energy", "valence", "acousticness",
+    "instrumentalness", "liveness", "loudness", "speechiness",
+)
+KEY_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+
+PROMPT_TEMPLATE = """SYSTEM:
+You are a music recommendation assistant. Output ONLY a JSON list (array) of EXACTLY {count} objects.
+Each object MUST have exactly these keys with these types:
+"name": string (track title)
+"artist": array of strings (list of artist names; use a list even if there is only one artist)
+No other text, no markdown, no extra keys.
+
+INSTRUCTIONS:
+SEED_PROFILE summarizes the seed playlist: per-feature median and quantiles (p10, p25, p75, p90), key/mode/time signature counts, the most frequent artists and a few example tracks.
+Recommend {count} DISTINCT tracks that are similar to the overall seed profile.
+SWIPE_FEEDBACK, unless "(none)", gives how many tracks the listener liked and passed on so far, and per feature how far those tracks' mean sits from the seed median. Move towards the liked shift and away from the passed one.
+You MUST infer likely genres of the seeds from your knowledge of the tracks/artists and use those inferred genres when selecting recommendations.
+Do NOT return any seed tracks or those specifically disallowed. In other words DO NOT recommend any songs listed under DISALLOWED ("title — artist", one per line) or that you have already mentioned.
+Diversity: cap at 2 tracks involving the same artist name (across any position in the artist list).
+
+OPTIMIZATION (in order):
+1) Match audio profile: keep tempo within ±8% of the median seed tempo; prefer similar danceability, energy, and valence; respect mode and time_signature when helpful.
+2) Incorporate inferred genres: align with the top inferred genres; include a mix across those genres.
+3) Reflect the categories below (moods/use-cases/constraints) across the set.
+
+SEED_PROFILE:
+{profile}
+
+SWIPE_FEEDBACK:
+{feedback}
+
+DISALLOWED:
+{disallowed}
+
+OUTPUT SHAPE EXAMPLE (structure only):
+[
+  {{"name": "Track Title 1", "artist": ["Primary Artist 1"]}},
+  {{"name": "Track Title 2", "artist": ["Artist A", "Artist B"]}},
+  ...
+]
+Return ONLY the JSON array ({count} items)."""
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token for English/JSON); good enough for budgeting"""
+    return (len(text) + 3) // 4
+
+
+def summarize_seeds(seeds, features, top_artists=PROMPT_TOP_ARTISTS, examples=PROMPT_EXAMPLE_SEEDS):
+    """
+    Compact numeric profile of the seed songs: rows shaped like db.get_seed_songs() and their
+    (n, len(STORED_FEATURES)) feature matrix, summarized column-wise with NumPy.
+    Feature values missing from every seed are left out.
+    """
+    import numpy as np
+    from similarity import STORED_FEATURES
+
+    features = np.asarray(features, dtype=float).reshape(len(seeds), len(STORED_FEATURES))
+
+    def column(name):
+        values = features[:, STORED_FEATURES.index(name)]
+        return values[~np.isnan(values)]
+
+    summary = {}
+    for name in NUMERIC_FEATURES:
+        values = column(name)
+        if not len(values):
+            continue
+        p10, p25, median, p75, p90 = np.percentile(values, [10, 25, 50, 75, 90])
+        digits = 1 if name in ("tempo", "loudness") else 3
+        summary[name] = {
+            "median": round(float(median), digits),
+            "q": [round(float(v), digits) for v in (p10, p25, p75, p90)],
+        }
+
+    def counts(name, label, valid=lambda v: True):
+        values, n = np.unique(column(name), return_counts=True)
+        return dict(Counter({label(v): int(c) for v, c in zip(values, n) if valid(v)}).most_common())
+
+    artists = Counter(a for s in seeds for a in (s["author_name"] or []))
+
+    return {
+        "seed_count": len(seeds),
+        "features": summary,
+        "key": counts("key", lambda v: KEY_NAMES[int(v)], lambda v: 0 <= v < 12 and v == int(v)),
+        "mode": counts("mode", lambda v: "major" if v == 1 else "minor"),
+        "time_signature": counts("time_signature", lambda v: str(int(v))),
+        "top_artists": [a for a, _ in artists.most_common(top_artists)],
+        "example_tracks": [f"{s['song_name']} — {', '.join(s['author_name'] or [])}" for s in seeds[:examples]],
+    }
+
+
+def exclusion_lines(seeds, history):
+    """
+    Deduplicated "title — first artist" lines for everything Gemini must not suggest,
+    most recent history first, then seeds. Duplicates are detected case-insensitively.
+    """
+    lines = []
+    seen = set()
+    entries = [(h["name"], h["artist"]) for h in reversed(history)]
+    entries += [(s["song_name"], s["author_name"]) for s in seeds]
+    for name, artists in entries:
+        first = artists[0] if isinstance(artists, list) and artists else (artists or "")
+        key = (str(name).strip().lower(), str(first).strip().lower())
+        if key in seen:
+            continue
+        seen.add(key)
+        lines.append(f"{name} — {first}" if first else str(name))
+    return lines
+
+
+def feedback_shift(taste, seed_features):
+    """
+    Compact form of a taste profile summary (similarity.TasteProfile.summary) for the prompt:
+    per side, the swipe count and how far the mean of each feature sits from the seed median.
+    Shifts smaller than FEEDBACK_MIN_SHIFT x the seeds' interquartile range are left out.
+    None before the first swipe.
+    """
+    if not taste:
+        return None
+    result = {}
+    for side in ("liked", "passed"):
+        stats = taste.get(side) or {}
+        if not stats.get("count"):
+            continue
+        shift = {}
+        for name, mean in stats["mean"].items():
+            seed = seed_features.get(name)
+            if seed is None:
+                continue
+            p10, p25, p75, p90 = seed["q"]
+            delta = mean - seed["median"]
+            if abs(delta) >= FEEDBACK_MIN_SHIFT * max(p75 - p25, 1e-6):
+                shift[name] = round(delta, 1 if name in ("tempo", "loudness") else 3)
+        result[side] = {"count": stats["count"], "shift": shift}
+    return result or None
+
+
+def cache_key(seeds, history, count=10, taste=None):
+    """
+    Canonical hash of what a prompt asks for: the seed set, the exclusion set, the taste profile
+    and the count. Order and duplicates don't matter, so the same playlist linked by different
+    sessions (or a retried request) maps to the same key.
+    """
+    canonical = {
+        "template": hashlib.sha256(PROMPT_TEMPLATE.encode()).hexdigest(),
+        "count": count,
+        "seeds": sorted({s["spotify_song_id"] for s in seeds}),
+        "exclude": sorted(set(exclusion_lines([], history))),
+        "taste": taste,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+def build_prompt(seeds, features, history, count=10, token_budget=PROMPT_TOKEN_BUDGET, taste=None):
+    """
+    Builds the Gemini prompt from the session's seeds (db.get_seed_songs rows + feature matrix),
+    recommendation history (get_recommendations rows) and taste profile summary (only its
+    shift from the seeds is sent, see feedback_shift), keeping it within token_budget.
+    When over budget the tail of the exclusion list is dropped first (seeds, then the
+    oldest history), then example tracks.
+
+    Returns:
+        (str, dict): the prompt and its size report
+    """
+    profile = summarize_seeds(seeds, features)
+    feedback = feedback_shift(taste, profile["features"])
+    exclusions = exclusion_lines(seeds, history)
+
+    def render(kept):
+        return PROMPT_TEMPLATE.format(
+            count=count,
+            profile=json.dumps(profile, ensure_ascii=False, separators=(",", ":")),
+            feedback=json.dumps(feedback, separators=(",", ":")) if feedback else "(none)",
+            disallowed="\n".join(exclusions[:kept]) or "(none)",
+        )
+
+    kept = len(exclusions)
+    prompt = render(kept)
+    if estimate_tokens(prompt) > token_budget:
+        # binary search for the largest exclusion prefix that fits
+        lo, hi = 0, kept
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if estimate_tokens(render(mid)) <= token_budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        kept = lo
+        prompt = render(kept)
+        while estimate_tokens(prompt) > token_budget and profile["example_tracks"]:
+            profile["example_tracks"].pop()
+            prompt = render(kept)
+
+    report = {
+        "chars": len(prompt),
+        "approx_tokens": estimate_tokens(prompt),
+        "token_budget": token_budget,
+        "seeds": len(seeds),
+        "swipes": sum(side["count"] for side in feedback.values()) if feedback else 0,
+        "exclusions": kept,
+        "exclusions_dropped": len(exclusions) - kept,
+    }
+    return prompt, report
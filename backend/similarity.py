@@ -0,0 +1,223 @@
+import numpy as np
+
+
+# Recco features used for similarity. key and time_signature are categorical, so they are left out.
+VECTOR_FEATURES = (
+    "tempo", "danceability", "energy", "valence", "acousticness",
+    "instrumentalness", "liveness", "loudness", "speechiness", "mode",
+)
+
+# Every Recco feature, in the column order of the packed float32 blobs in db.Song.features
+STORED_FEATURES = (
+    "tempo", "danceability", "energy", "valence", "acousticness", "instrumentalness",
+    "liveness", "loudness", "speechiness", "key", "mode", "time_signature",
+)
+_MISSING_BLOB = np.full(len(STORED_FEATURES), np.nan, dtype=np.float32).tobytes()
+
+# Floor for each feature's spread so a very uniform seed set doesn't blow distances up
+# (BPM, 0-1 scores, dB, 0/1 mode)
+_MIN_SCALE = np.array([2.0, 0.02, 0.02, 0.02, 0.02, 0.02, 0.02, 0.5, 0.02, 0.1])
+
+
+def pack_features(features):
+    """Recco feature dict -> float32 blob in STORED_FEATURES order (NaN = missing); None without any features"""
+    if not features:
+        return None
+    values = [features.get(name) for name in STORED_FEATURES]
+    if all(v is None for v in values):
+        return None
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float32).tobytes()
+
+
+def unpack_features(blobs, columns=VECTOR_FEATURES):
+    """
+    (n, len(columns)) float32 matrix from packed feature blobs in one np.frombuffer call;
+    None (or malformed) blobs give NaN rows. columns picks and orders the features.
+    """
+    width = len(_MISSING_BLOB)
+    buffer = b"".join(blob if blob is not None and len(blob) == width else _MISSING_BLOB for blob in blobs)
+    matrix = np.frombuffer(buffer, dtype=np.float32).reshape(-1, len(STORED_FEATURES))
+    return matrix[:, [STORED_FEATURES.index(name) for name in columns]]
+
+
+def feature_matrix(feature_dicts):
+    """(n, len(VECTOR_FEATURES)) float matrix from Recco feature dicts; missing values are NaN"""
+    matrix = np.full((len(feature_dicts), len(VECTOR_FEATURES)), np.nan)
+    for i, features in enumerate(feature_dicts):
+        if not features:
+            continue
+        for j, name in enumerate(VECTOR_FEATURES):
+            value = features.get(name)
+            if value is not None:
+                matrix[i, j] = value
+    return matrix
+
+
+class Normalizer:
+    """Per-feature z-scoring. Missing values land on the mean (0 after scaling)."""
+
+    def __init__(self, reference):
+        reference = np.asarray(reference, dtype=float)
+        present = ~np.isnan(reference)
+        counts = present.sum(axis=0)
+        filled = np.where(present, reference, 0.0)
+        self.mean = np.divide(filled.sum(axis=0), counts, out=np.zeros(reference.shape[1]), where=counts > 0)
+        centered = np.where(present, reference - self.mean, 0.0)
+        var = np.divide((centered ** 2).sum(axis=0), counts, out=np.zeros(reference.shape[1]), where=counts > 0)
+        self.scale = np.maximum(np.sqrt(var), _MIN_SCALE)
+
+    def __call__(self, raw):
+        z = (np.asarray(raw, dtype=float) - self.mean) / self.scale
+        return np.nan_to_num(z, nan=0.0)
+
+
+class SeedProfile:
+    """Centroid of the seeds in normalized space, plus how far the seeds themselves spread from it"""
+
+    def __init__(self, normalizer, seed_raw):
+        self.normalizer = normalizer
+        has_features = ~np.all(np.isnan(seed_raw), axis=1) if len(seed_raw) else np.zeros(0, dtype=bool)
+        seeds = normalizer(seed_raw[has_features]) if has_features.any() else np.zeros((0, len(VECTOR_FEATURES)))
+        self.size = len(seeds)
+        self.centroid = seeds.mean(axis=0) if self.size else np.zeros(len(VECTOR_FEATURES))
+        # 90th percentile of seed-to-centroid distance: "inside the playlist's profile"
+        self.radius = float(np.percentile(np.linalg.norm(seeds - self.centroid, axis=1), 90)) if self.size else 0.0
+
+    def distances(self, raw):
+        """Distance of each row of raw (un-normalized) features to the centroid; NaN for all-missing rows"""
+        raw = np.asarray(raw, dtype=float)
+        d = np.linalg.norm(self.normalizer(raw) - self.centroid, axis=1)
+        if len(raw):
+            d[np.all(np.isnan(raw), axis=1)] = np.nan
+        return d
+
+
+class FeatureIndex:
+    """
+    kNN index over a catalog of tracks with known audio features.
+    ids and payloads are kept aligned with the rows of the matrix.
+    """
+
+    def __init__(self, ids, raw, payloads=None):
+        self.ids = list(ids)
+        self.raw = np.asarray(raw, dtype=float).reshape(len(self.ids), len(VECTOR_FEATURES))
+        self.payloads = list(payloads) if payloads is not None else [None] * len(self.ids)
+        self.normalizer = Normalizer(self.raw) if len(self.ids) else None
+        self.vectors = self.normalizer(self.raw) if len(self.ids) else self.raw
+
+    def __len__(self):
+        return len(self.ids)
+
+    def profile(self, seed_raw):
+        return SeedProfile(self.normalizer, np.asarray(seed_raw, dtype=float))
+
+    def nearest(self, profile, exclude=()):
+        """Yields (id, payload, distance) nearest-first, skipping ids in exclude"""
+        if not len(self.ids):
+            return
+        distances = np.linalg.norm(self.vectors - profile.centroid, axis=1)
+        for i in np.argsort(distances, kind="stable"):
+            if self.ids[i] in exclude:
+                continue
+            yield self.ids[i], self.payloads[i], float(distances[i])
+
+
+def rerank(seed_raw, candidate_raw, max_distance_factor=None):
+    """
+    Orders candidates by closeness to the seed profile.
+    Candidates farther than max_distance_factor * the seeds' own radius are dropped;
+    candidates without features can't be judged, so they are kept at the end.
+
+    Returns:
+        list: candidate positions, best first
+    """
+    seed_raw = np.asarray(seed_raw, dtype=float)
+    candidate_raw = np.asarray(candidate_raw, dtype=float)
+    if not len(candidate_raw):
+        return []
+    profile = SeedProfile(Normalizer(np.vstack([seed_raw, candidate_raw])), seed_raw)
+    if not profile.size:
+        return list(range(len(candidate_raw)))
+
+    distances = profile.distances(candidate_raw)
+    unknown = np.isnan(distances)
+    keep = ~unknown
+    if max_distance_factor is not None and profile.radius > 0:
+        keep &= distances <= profile.radius * max_distance_factor
+    order = [int(i) for i in np.argsort(np.where(keep, distances, np.inf), kind="stable") if keep[i]]
+    return order + [int(i) for i in np.flatnonzero(unknown)]
+
+
+class RunningStats:
+    """
+    Weighted mean / variance of feature vectors, updated one observation at a time in O(features)
+    (West's weighted Welford). Missing (NaN) values are skipped per feature, so each feature keeps
+    its own weight total. Serializes to plain lists for the taste_profiles table.
+    """
+
+    def __init__(self, dims=len(VECTOR_FEATURES)):
+        self.count = 0
+        self.weight = np.zeros(dims)
+        self.mean = np.zeros(dims)
+        self.m2 = np.zeros(dims)
+
+    def add(self, x, weight=1.0):
+        x = np.asarray(x, dtype=float)
+        present = ~np.isnan(x)
+        if not present.any() or weight <= 0:
+            return
+        self.count += 1
+        self.weight[present] += weight
+        delta = x[present] - self.mean[present]
+        self.mean[present] += delta * (weight / self.weight[present])
+        self.m2[present] += weight * delta * (x[present] - self.mean[present])
+
+    def variance(self):
+        """Weighted population variance; NaN for features never observed"""
+        return np.divide(self.m2, self.weight, out=np.full(len(self.m2), np.nan), where=self.weight > 0)
+
+    def to_dict(self):
+        return {"count": self.count, "weight": self.weight.tolist(), "mean": self.mean.tolist(), "m2": self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        if data:
+            stats.count = data["count"]
+            stats.weight = np.asarray(data["weight"], dtype=float)
+            stats.mean = np.asarray(data["mean"], dtype=float)
+            stats.m2 = np.asarray(data["m2"], dtype=float)
+        return stats
+
+
+class TasteProfile:
+    """Running stats of the audio features of the tracks a session liked, and of the ones it passed on"""
+
+    def __init__(self, liked=None, passed=None):
+        self.liked = liked or RunningStats()
+        self.passed = passed or RunningStats()
+
+    def add(self, features, liked, weight=1.0):
+        """Folds one swipe in; features is a Recco feature dict (None when Recco has none)"""
+        (self.liked if liked else self.passed).add(feature_matrix([features])[0], weight)
+
+    def summary(self):
+        """{"liked"|"passed": {"count", "mean": {feature: v}, "std": {feature: v}}}, observed features only"""
+        result = {}
+        for side, stats in (("liked", self.liked), ("passed", self.passed)):
+            std = np.sqrt(stats.variance())
+            observed = [j for j in range(len(VECTOR_FEATURES)) if stats.weight[j] > 0]
+            result[side] = {
+                "count": stats.count,
+                "mean": {VECTOR_FEATURES[j]: float(stats.mean[j]) for j in observed},
+                "std": {VECTOR_FEATURES[j]: float(std[j]) for j in observed},
+            }
+        return result
+
+    def to_dict(self):
+        return {"liked": self.liked.to_dict(), "passed": self.passed.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(RunningStats.from_dict(data.get("liked")), RunningStats.from_dict(data.get("passed")))